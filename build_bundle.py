@@ -0,0 +1,34 @@
+"""
+Pre-render the product matrix (or the most requested diagrams from a
+JSONL log) into a content-addressed bundle shipped with the package.
+Exact matches are then served from the bundle with no rendering.
+"""
+from purerackdiagram import bundle
+
+
+def main(args):
+    if args.requests:
+        all_params = bundle.read_params_file(args.requests)
+        all_params = bundle.top_params(all_params, args.top)
+    else:
+        all_params = bundle.product_matrix()
+        if args.top:
+            all_params = all_params[:args.top]
+
+    num_entries, num_objects = bundle.build(all_params, args.output, args.t)
+    print("Wrote {} entries, {} unique images to {}".format(
+        num_entries, num_objects, args.output))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', default=bundle.bundle_path,
+                        help="bundle zip to write")
+    parser.add_argument('--requests',
+                        help="JSONL of request params, bundle the most "
+                             "requested instead of the product matrix")
+    parser.add_argument('--top', type=int, default=0,
+                        help="only bundle the top N diagrams")
+    parser.add_argument('-t', type=int, help="number of threads", default=1)
+    main(parser.parse_args())
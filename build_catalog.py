@@ -0,0 +1,39 @@
+"""
+Render a gallery of diagrams to a directory or zip with a manifest.
+Reruns only re-render outputs whose assets, config entries or render
+code changed.
+
+    python build_catalog.py -o catalog/
+    python build_catalog.py requests.jsonl -o catalog.zip
+    python build_catalog.py spec.json -o catalog/ -t 8
+
+spec.json is a matrix spec, every combination is rendered:
+    {"model": ["fa-x20r3", "fa-x70r3"], "face": ["front", "back"],
+     "datapacks": "63/63"}
+"""
+import logging
+from purerackdiagram import catalog
+
+
+def main(args):
+    all_params = catalog.read_input(args.input)
+    counts = catalog.build(all_params, args.output, args.t, args.force)
+    print("{rendered} rendered, {unchanged} unchanged, {removed} removed, "
+          "{failed} failed".format(**counts))
+
+
+if __name__ == "__main__":
+    import argparse
+    # invalid combinations are reported in the summary
+    logging.getLogger().setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', nargs='?',
+                        help="JSONL of params or a JSON matrix spec, "
+                             "default is the full product matrix")
+    parser.add_argument('-o', '--output', default="catalog",
+                        help="output directory, or a .zip file")
+    parser.add_argument('-t', type=int, default=None,
+                        help="number of processes, default cpu count")
+    parser.add_argument('--force', action='store_true',
+                        help="re-render everything")
+    main(parser.parse_args())
@@ -5,12 +5,18 @@ at the same time.  Will return which ever is created or found first.
 
 All AWS specific stuff and s3 caching is here.
 """
+import atexit
+import signal
+import sys
+import threading
 import time
 from io import BytesIO
-import asyncio
-import base64
+import binascii
+import json
 import logging
 import purerackdiagram
+import purerackdiagram.profiler
+from purerackdiagram import metrics
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
@@ -22,6 +28,26 @@ logger.setLevel(logging.INFO)
 version = 4
 program_time_s = time.time()
 
+# keep the most requested diagrams warm in the background, the sketch
+# of what's popular is persisted at this path across containers
+if os.environ.get("PURERACK_PREWARM"):
+    purerackdiagram.prewarm.start(os.environ["PURERACK_PREWARM"])
+
+
+def flush_persisted(signum=None, frame=None):
+    # lambda gives a container about 2s after SIGTERM, which it only
+    # sends when an extension is registered, atexit covers the rest
+    purerackdiagram.persist.stop(timeout=1.5)
+    if signum is not None:
+        sys.exit(0)
+
+
+# renders queued for persistence are written before the container goes
+if purerackdiagram.persist.enabled():
+    atexit.register(flush_persisted)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, flush_persisted)
+
 
 def text_to_image(text, width):
     root_path = os.path.dirname(purerackdiagram.__file__)
@@ -53,6 +79,58 @@ def text_to_image(text, width):
     return img
 
 
+def dry_run(params):
+    """ Only parse and validate the params, no images are loaded.
+    Returns the normalized config as json, or the validation error
+    as json instead of an error image.  A config over the memory budget
+    is not valid, its render would be rejected.
+    """
+    try:
+        body = {"valid": True,
+                "config": purerackdiagram.get_metadata(params)}
+        status_code = 200
+    except Exception as e:
+        logger.error("{}\nOriginal Params: {}".format(str(e), params))
+        metrics.errors.inc(type(e).__name__, "validation")
+        body = {"valid": False,
+                "error": str(e)}
+        status_code = 400
+
+    return {
+        "statusCode": status_code,
+        "body": json.dumps(body),
+        "headers": {"Content-Type": "application/json"},
+        "isBase64Encoded": False
+    }
+
+
+# seconds kept back from the lambda's remaining time for the response
+response_margin_s = 1.0
+
+vssx_templates = {}
+
+
+def read_template(name):
+    # the vssx templates never change, read them once per container
+    if name not in vssx_templates:
+        path = os.path.join(os.path.dirname(__file__), "vssx", name)
+        with open(path, 'rb') as f:
+            vssx_templates[name] = f.read()
+    return vssx_templates[name]
+
+
+def encode_body(response):
+    """ Replace the response's bytes-like body with its base64 str,
+        encoded straight from its buffer.
+    """
+    body = response.pop("body")
+    with memoryview(body) as view:
+        encoded = binascii.b2a_base64(view, newline=False)
+    # a vssx buffer isn't held anywhere else, free it before the str is
+    # made so only two copies are ever alive at once
+    del body
+    response["body"] = encoded.decode('ascii')
+
 
 def handler(event, context):
     """ This is the entry point for AWS Lambda, API Gateway
@@ -65,38 +143,125 @@ def handler(event, context):
     global program_time_s
     program_time_s = time.time()
 
-    try:
-        if ("queryStringParameters" not in event
-                or event["queryStringParameters"] is None):
+    if ("queryStringParameters" not in event
+            or event["queryStringParameters"] is None):
+
+        return {"statusCode": 500,
+                "body": "no query params. event={} and context={}".format(
+                    event,
+                    vars(context))}
+
+    # give up on the render before the lambda is timed out, leaving time
+    # to send the response
+    remaining_s = None
+    if hasattr(context, "get_remaining_time_in_millis"):
+        remaining_s = max(0.001,
+                          context.get_remaining_time_in_millis() / 1000.0
+                          - response_margin_s)
+    cancel = purerackdiagram.cancellation.CancelToken.for_request(
+        remaining_s)
+
+    response = respond(event["queryStringParameters"], cancel=cancel)
+    if response["isBase64Encoded"]:
+        # binary bodies are a view of the buffer they were assembled in,
+        # API gateway needs them as base64 text
+        encode_body(response)
+    return response
+
+
+def profiled(params, cancel=None):
+    """ respond() under the profiler when the profile token is right,
+        see purerackdiagram.profiler.
+    """
+    params = dict(params)
+    token = params.pop('profile')
+    output = params.pop('profile_output', None)
+    if not purerackdiagram.profiler.authorized(token):
+        return {"statusCode": 403,
+                "body": "Profiling is not allowed",
+                "headers": {"Content-Type": "text/plain"},
+                "isBase64Encoded": False}
+
+    with purerackdiagram.profiler.Capture() as capture:
+        response = respond(params, profiling=True, cancel=cancel)
+    report = capture.save(purerackdiagram.profiler.report_name(params))
+
+    profile_headers = {"X-Profile": os.path.basename(report.path),
+                       "X-Profile-Seconds": "{:.3f}".format(report.seconds)}
+    if output == "text":
+        return {"statusCode": 200,
+                "body": report.text,
+                "headers": {"Content-Type": "text/plain", **profile_headers},
+                "isBase64Encoded": False}
+    response["headers"].update(profile_headers)
+    return response
+
+
+def respond(params, profiling=False, cancel=None):
+    """ The response for params with a raw body, bytes or a memoryview of
+        the png or vssx when isBase64Encoded is set.  Server modes send
+        it as is, handler() base64 encodes it for the lambda.  The render
+        stops early once cancel, a cancellation.CancelToken, is
+        cancelled.
+    """
+    if 'profile' in params and not profiling:
+        return profiled(params, cancel)
 
-            return {"statusCode": 500,
-                    "body": "no query params. event={} and context={}".format(
-                        event,
-                        vars(context))}
+    # where a failure happened, for the error metrics
+    stage = "request"
+    try:
+        face = params.get('face', 'front')
+        metrics.requests.inc(
+            metrics.model_family(params.get('model', 'fa')),
+            face if face in ['front', 'back'] else 'front')
 
-        params = event["queryStringParameters"]
+        # metadata only, skip all image loading and encoding
+        if purerackdiagram.utils.is_true(params.get('dry_run', False)):
+            return dry_run(params)
 
         # Initialize our diagram from the params, parse all the params
+        stage = "validation"
         diagram = purerackdiagram.get_diagram(params)
+        diagram.profiling = profiling
+        diagram.cancel = cancel
+        stage = "render"
 
-        # do the work to generate the image
-        img = asyncio.run(diagram.get_image())
-
-        # resize if too large:
         # will break google slides if file is too big
         max_height = 4604
-        if img.size[1] > max_height:
-            wpercent = (max_height/float(img.size[1]))
-            hsize = int((float(img.size[0]) * float(wpercent)))
-            img = img.resize((hsize, max_height), Image.ANTIALIAS)
 
-        # reformat image to be passed back directly to API caller
-        buffered = BytesIO()
-        img.save(buffered, format="PNG")
+        # stencils cost more, they're scheduled in the bulk lane sooner
+        output_format = "vssx" if params.get('vssx') else "png"
+
+        # do the work to generate the image, or get it from the bundle
+        # or render cache
+        output_headers = {}
+        if params.get('max_bytes'):
+            # max_bytes is the response body, base64 grows the png by 4/3
+            png_budget = int(params['max_bytes']) * 3 // 4
+            png, _, chosen = purerackdiagram.render_png_fit(
+                diagram, png_budget, max_height, output_format)
+            output_headers = {
+                "X-Output-Scale": str(chosen['scale']),
+                "X-Output-Mode": chosen['mode'],
+                "X-Output-Compress-Level": str(chosen['compress_level']),
+                "X-Output-Size": "{}x{}".format(*chosen['size'])}
+        else:
+            png, _ = purerackdiagram.render_png(diagram, max_height,
+                                                output_format)
+
+        # estimated and measured image memory of this render, for tuning
+        # the memory budgets, not set when it came from the bundle or a
+        # cache
+        rendered = getattr(diagram, "memory", None)
+        if rendered:
+            output_headers["X-Memory-Estimate"] = str(rendered["estimate"])
+            if rendered["peak"] is not None:
+                output_headers["X-Memory-Peak"] = str(rendered["peak"])
+            output_headers["X-Render-Lane"] = diagram.lane
 
         # do we want a visio template or the raw image:
         if 'vssx' in params and params['vssx']:
-            ru = diagram.config['ru']
+            ru = diagram.get_ru()
             h_inches = "{:.2f}".format(ru*1.75)
 
             #generate a name for this config
@@ -115,26 +280,22 @@ def handler(event, context):
 
             for n in items:
                 name += "_" + str(diagram.config[n])
+            if diagram.region is not None:
+                region = diagram.region
+                name += "".join("_" + n for n in region.get("component", []))
+                if "ru_range" in region:
+                    name += "_ru{}-{}".format(*region["ru_range"])
 
             # building a visio template
-            root_path = os.path.dirname(__file__)
-            vssx_path = os.path.join(root_path, "vssx/vssx_template.zip")
-            master1_template_path = os.path.join(root_path, "vssx/master1_template.xml")
-            masters_template_path = os.path.join(root_path, "vssx/masters_template.xml")
-
             # adjust the stencil height
-            master1 = None
-            with open(master1_template_path, 'r') as mf:
-                master1 = mf.read()
+            master1 = read_template("master1_template.xml").decode('utf-8')
 
             master1 = master1.replace('<template_h_in>', h_inches)
             master1 = master1.replace('<template_h_u>', str(ru))
             master1 = master1.replace('<template_name>', stencil_name)
 
             # create uniqueID for this template
-            masters = None
-            with open(masters_template_path, 'r') as mf:
-                masters = mf.read()
+            masters = read_template("masters_template.xml").decode('utf-8')
             
             stamp = int((time.time())*10)
             # Get only the right 7 digits of HEX
@@ -144,33 +305,30 @@ def handler(event, context):
             
             # do import down here, so we don't have load if not needed
             import zipfile
-            import io
-
-            # read file into memory
-            zipfile_raw = None
-            with open(vssx_path, 'rb') as vssx_file:
-                zipfile_raw = vssx_file.read()
 
-            zipfile_buffered = io.BytesIO(zipfile_raw)
+            # the stencil is assembled in one buffer, the template is
+            # copied into it on the first write and the body is a view of
+            # it, not another copy
+            zfb = BytesIO(read_template("vssx_template.zip"))
 
             # add the image and master1 file to zip file.
-            with zipfile_buffered as zfb:
-                with zipfile.ZipFile(zfb, 'a') as zipf:
-                    # Add a file located at the source_path to the destination within the zip
-                    zipf.writestr('visio/media/image1.png', buffered.getvalue())
-                    zipf.writestr('visio/masters/master1.xml', master1)
-                    zipf.writestr('visio/masters/masters.xml', masters)
-                    zipf.close()
-                zip_str = base64.b64encode(zfb.getvalue()).decode('utf-8')
+            with zipfile.ZipFile(zfb, 'a') as zipf:
+                # Add a file located at the source_path to the destination within the zip
+                zipf.writestr('visio/media/image1.png', png)
+                zipf.writestr('visio/masters/master1.xml', master1)
+                zipf.writestr('visio/masters/masters.xml', masters)
+            body = zfb.getbuffer()
+            metrics.output_bytes.observe(len(body), "vssx")
 
             # when running in lambda we HAVE to wait until
             # upload done before returning
             content_disposition = 'attachment; filename="{}.vssx"'.format(name)
             return_data = {
                 "statusCode": 200,
-                "body": zip_str,
+                "body": body,
                 "headers": {"Content-Type": "application/vnd.ms-visio.stencil",
-                            'content-disposition': content_disposition},
+                            'content-disposition': content_disposition,
+                            **output_headers},
                 "isBase64Encoded": True
             }
 
@@ -178,35 +336,47 @@ def handler(event, context):
 
         else:
 
-            # convert to base64 and encode utf-8
-            # this is required for a binary object passed back
-            # through amazon API gateway
-            img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+            # the png as is, handler() base64 encodes it for
+            # amazon API gateway
+            metrics.output_bytes.observe(len(png), "png")
 
             # when running in lambda we HAVE to wait until
             # upload done before returning
             return_data = {
                 "statusCode": 200,
-                "body": img_str,
-                "headers": {"Content-Type": "image/png"},
+                "body": png,
+                "headers": {"Content-Type": "image/png", **output_headers},
                 "isBase64Encoded": True
             }
 
             return return_data
 
+    except purerackdiagram.cancellation.Cancelled as e:
+        # nobody is waiting for an error image
+        logger.info("{}\nOriginal Params: {}".format(str(e), params))
+        metrics.cancelled.inc(e.reason, e.stage)
+        return {
+            "statusCode": 504 if e.reason == "deadline" else 499,
+            "body": str(e),
+            "headers": {"Content-Type": "text/plain",
+                        "X-Cancelled": e.reason},
+            "isBase64Encoded": False
+        }
+
     except Exception as e:
         error_msg = str(e)
         logger.error("{}\nOriginal Params: {}".format(error_msg, params))
+        metrics.errors.inc(type(e).__name__, stage)
 
         # return the error message as an image
         img = text_to_image(error_msg, 1024)
         buffered = BytesIO()
         img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
 
         return {
             "statusCode": 200,
-            "body": img_str,
-            "headers": {"Content-Type": "image/png"},
+            "body": buffered.getbuffer(),
+            "headers": {"Content-Type": "image/png",
+                        "X-Error": type(e).__name__},
             "isBase64Encoded": True
         }
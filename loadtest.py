@@ -0,0 +1,304 @@
+"""
+Replay a JSONL log of request params against the renderer and report
+throughput, latency percentiles, error rate, peak RSS and cache hit
+ratios.  Against the http target the renders run in the server, the RSS
+is the load generator's own and reported as client_peak_rss_mb.
+
+Each line of the log is either bare query params or a full lambda event
+with "queryStringParameters".  Lines are replayed in order and the log
+wraps around until the duration or request count is reached.
+
+Targets:
+    handler   lambdaentry.handler(), in process
+    library   purerackdiagram.get_image_bytes_png_sync(), in process
+    http      GET against --url with the params as the query string
+
+Scenarios:
+    warm      one process, caches warmed with a pass over the log first
+    cold      every request runs in a freshly spawned interpreter, like a
+              new lambda container, import time is reported separately
+
+    python loadtest.py requests.jsonl -c 4 -d 30
+    python loadtest.py requests.jsonl --rate 5 -d 60 --target http \\
+        --url http://localhost:8080/
+    python loadtest.py requests.jsonl --scenario cold -n 20
+"""
+import argparse
+import json
+import logging
+import queue
+import resource
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+# the handler logs every failed request, they are counted instead
+logging.disable(logging.ERROR)
+
+
+class TargetError(Exception):
+    """ A failure reported by the target, str() is the error type. """
+
+
+def error_name(e):
+    if isinstance(e, TargetError):
+        return str(e)
+    return type(e).__name__
+
+
+def get_target(args):
+    """ Returns a function taking params that raises on any failure. """
+    if args.target == "handler":
+        import lambdaentry
+
+        def call(params):
+            result = lambdaentry.handler(
+                {"queryStringParameters": dict(params)}, None)
+            # errors come back as a 200 error image, flagged in a header
+            if "X-Error" in result["headers"]:
+                raise TargetError(result["headers"]["X-Error"])
+            if result["statusCode"] != 200:
+                raise TargetError("status {}".format(result["statusCode"]))
+            return len(result["body"])
+        return call
+
+    if args.target == "library":
+        import purerackdiagram
+
+        def call(params):
+            return len(purerackdiagram.get_image_bytes_png_sync(
+                dict(params)).getvalue())
+        return call
+
+    if not args.url:
+        raise Exception("--url is required for the http target")
+
+    def call(params):
+        url = args.url + "?" + urllib.parse.urlencode(params)
+        with urllib.request.urlopen(url, timeout=args.timeout) as response:
+            body = response.read()
+            # errors come back as a 200 error image, as from the handler
+            if response.headers.get("X-Error"):
+                raise TargetError(response.headers["X-Error"])
+            return len(body)
+    return call
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * len(values))) - 1)
+    return values[max(index, 0)]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def rss_name(target):
+    # over http only the load generator's own memory is measured
+    return "client_peak_rss_mb" if target == "http" else "peak_rss_mb"
+
+
+def cache_ratios():
+    import sys
+    if "purerackdiagram" not in sys.modules:
+        return {}
+
+    from purerackdiagram import utils, bundle, cache
+    ratios = {}
+    for name, stats in [("asset", utils.cache_stats),
+                        ("bundle", bundle.stats),
+                        ("component", cache.component_cache.stats),
+                        ("label", cache.label_cache.stats),
+                        ("render", cache.render_cache.stats)]:
+        total = stats["hits"] + stats["misses"]
+        if total:
+            ratios[name] = stats["hits"] / float(total)
+    return ratios
+
+
+def run_warm(args, all_params):
+    call = get_target(args)
+
+    if args.target != "http":
+        # one pass so the measured run sees warm caches
+        for params in all_params:
+            try:
+                call(params)
+            except Exception:
+                pass
+
+    latencies = []
+    errors = {}
+    lock = threading.Lock()
+    work = queue.Queue(maxsize=args.c * 2)
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            params, scheduled = item
+            if scheduled is None:
+                # closed loop, the request starts when a worker is free
+                scheduled = time.perf_counter()
+            try:
+                call(params)
+                error = None
+            except Exception as e:
+                error = error_name(e)
+            # open loop latency is from the scheduled arrival, so
+            # queueing counts
+            elapsed = time.perf_counter() - scheduled
+            with lock:
+                latencies.append(elapsed)
+                if error:
+                    errors[error] = errors.get(error, 0) + 1
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(args.c)]
+    for t in threads:
+        t.start()
+
+    start = time.perf_counter()
+    sent = 0
+    while True:
+        now = time.perf_counter()
+        if args.d and now - start >= args.d:
+            break
+        if args.n and sent >= args.n:
+            break
+
+        if args.rate:
+            # open loop, requests arrive on schedule whether or not
+            # the earlier ones have finished
+            scheduled = start + sent / float(args.rate)
+            if scheduled > now:
+                time.sleep(scheduled - now)
+        else:
+            scheduled = None
+
+        work.put((all_params[sent % len(all_params)], scheduled))
+        sent += 1
+
+    for _ in threads:
+        work.put(None)
+    for t in threads:
+        t.join()
+
+    wall = time.perf_counter() - start
+    return {"latencies": latencies,
+            "errors": errors,
+            "wall": wall,
+            rss_name(args.target): peak_rss_mb(),
+            "cache_hit_ratio": cache_ratios()}
+
+
+def cold_request(target, url, timeout, params):
+    """ Runs in a fresh interpreter, measures import plus one request. """
+    start = time.perf_counter()
+    call = get_target(argparse.Namespace(target=target, url=url,
+                                         timeout=timeout))
+    init = time.perf_counter() - start
+
+    error = None
+    try:
+        call(params)
+    except Exception as e:
+        error = error_name(e)
+    total = time.perf_counter() - start
+    return init, total, error, peak_rss_mb()
+
+
+def run_cold(args, all_params):
+    import multiprocessing
+
+    # a new spawned interpreter per task is a cold container
+    ctx = multiprocessing.get_context("spawn")
+    count = args.n or len(all_params)
+    tasks = [(args.target, args.url, args.timeout,
+              all_params[i % len(all_params)]) for i in range(count)]
+
+    start = time.perf_counter()
+    with ctx.Pool(processes=args.c, maxtasksperchild=1) as pool:
+        results = pool.starmap(cold_request, tasks)
+    wall = time.perf_counter() - start
+
+    errors = {}
+    for _, _, error, _ in results:
+        if error:
+            errors[error] = errors.get(error, 0) + 1
+
+    return {"latencies": [r[1] for r in results],
+            "init_latencies": [r[0] for r in results],
+            "errors": errors,
+            "wall": wall,
+            rss_name(args.target): max(r[3] for r in results),
+            "cache_hit_ratio": {}}
+
+
+def report(result):
+    latencies = result["latencies"]
+    count = len(latencies)
+    num_errors = sum(result["errors"].values())
+    summary = {
+        "requests": count,
+        "throughput_rps": count / result["wall"] if result["wall"] else 0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "error_rate": num_errors / float(count) if count else 0,
+        "errors": result["errors"],
+    }
+    for name in ("peak_rss_mb", "client_peak_rss_mb"):
+        if name in result:
+            summary[name] = result[name]
+    summary["cache_hit_ratio"] = result["cache_hit_ratio"]
+    if "init_latencies" in result:
+        summary["init_p50_ms"] = \
+            percentile(result["init_latencies"], 50) * 1000
+    return summary
+
+
+def main(args):
+    from purerackdiagram.bundle import read_params_file
+
+    all_params = read_params_file(args.log)
+    if not all_params:
+        raise Exception("no params in {}".format(args.log))
+
+    if args.scenario == "cold":
+        result = run_cold(args, all_params)
+    else:
+        result = run_warm(args, all_params)
+
+    print(json.dumps(report(result), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log', help="JSONL of request params")
+    parser.add_argument('--target', choices=['handler', 'library', 'http'],
+                        default='handler')
+    parser.add_argument('--url', help="endpoint for the http target")
+    parser.add_argument('--scenario', choices=['warm', 'cold'],
+                        default='warm')
+    parser.add_argument('-c', type=int, default=1,
+                        help="concurrent requests")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="arrival rate in requests per second, "
+                             "default is closed loop")
+    parser.add_argument('-d', type=float, default=10,
+                        help="duration in seconds, 0 for no limit")
+    parser.add_argument('-n', type=int, default=0,
+                        help="number of requests, 0 for no limit")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="http request timeout in seconds")
+    args = parser.parse_args()
+    if args.scenario == "warm" and not args.d and not args.n:
+        parser.error("-d 0 needs a request count, -n")
+    main(args)
@@ -1,7 +1,18 @@
 from .flashblade import FBDiagram
 from .flasharray import FADiagram
+from .rack import RackDiagram
+from . import budget
+from . import bundle
+from . import utils
+from . import cache
+from . import cancellation
+from . import memory
+from . import metrics
+from . import persist
+from . import prewarm
+from . import scheduler
 from io import BytesIO
-import asyncio
+from PIL import Image
 
 default_array_model = 'fa-x20r2'
 
@@ -9,27 +20,183 @@ default_array_model = 'fa-x20r2'
 def get_diagram(params):
     model = params.get('model', default_array_model).lower()
     params['model'] = model
+    original_params = dict(params)
 
     if model.startswith("fa"):
         diagram = FADiagram(params)
     elif model.startswith("fb"):
         diagram = FBDiagram(params)
+    elif model.startswith("rack"):
+        diagram = RackDiagram(params)
     # elif model.startswith("oe"):
     #    diagram = OEDiagram(params)
     else:
-        raise Exception("Error unknown model, looking for fa or fb or oe")
+        raise Exception("Error unknown model, looking for fa, fb, rack or oe")
 
+    # rejected before anything walks its components, a huge chassis
+    # count costs no more than a small one
+    memory.check_request(memory.image_bytes(diagram.estimate_size()))
+
+    # component and ru_range render only part of the diagram
+    diagram.region = utils.parse_region(params)
+    if diagram.region is not None:
+        # a region with nothing in it fails with the other bad params
+        diagram.get_layout()
+
+    # kept so the diagram can be rendered again, e.g. by the pre-warmer
+    diagram.params = original_params
     return diagram
 
 
-def get_image_sync(params):
+def get_metadata(params):
+    """ Parses and validates params without loading or rendering any
+        images.  Returns the normalized diagram config, ru count, pci
+        slot population and datapack to shelf mapping included, and
+        the estimated bytes of image memory a render needs next to the
+        per request budget.  A diagram over the budget raises like any
+        other invalid params, a render would be rejected.
+    """
+    diagram = get_diagram(params)
+    metadata = diagram.config.copy()
+    metadata['model'] = params['model']
+    if diagram.region is not None:
+        metadata['region'] = diagram.region
+        metadata['region_ru'] = diagram.get_ru()
+    metadata['memory_estimate'] = diagram.estimate_memory()
+    metadata['memory_budget'] = memory.request_budget
+    return metadata
+
+
+def render_sync(params):
+    """ Render on the calling thread without an event loop, the
+        fastest path for scripts and WSGI style hosts.
+    """
+    diagram = get_diagram(params)
+    return diagram.render()
+
+
+async def render_async(params):
+    """ Render on the caller's already running event loop, for aiohttp
+        or Jupyter hosts.  Shares the worker pool and caches with
+        render_sync.
+    """
     diagram = get_diagram(params)
-    img = asyncio.run(diagram.get_image())
+    return await diagram.get_image()
+
+
+def get_image_sync(params):
+    return render_sync(params)
+
+
+def render_digest(params):
+    """ sha256 of the rendered image's mode, size and raw pixels.  No PNG
+        encode, so it only changes when the pixels do, not when the
+        encoder or its settings change.
+    """
+    return utils.image_digest(render_sync(params))
+
+
+def scale_to_height(img, max_height):
+    # resize if too large:
+    if max_height and img.size[1] > max_height:
+        wpercent = (max_height/float(img.size[1]))
+        hsize = int((float(img.size[0]) * float(wpercent)))
+        img = img.resize((hsize, max_height), Image.ANTIALIAS)
     return img
 
 
-def get_image_bytes_png_sync(params):
+def find_render(diagram, key, max_height):
+    """ A finished render from the bundle, the render cache or the
+        persisted renders, None if there isn't one.
+    """
+    bundled = bundle.lookup(diagram)
+    if bundled is not None and (max_height is None or
+                                bundled[1][1] <= max_height):
+        return bundled
+
+    cached = cache.render_cache.get(key)
+    if cached is None:
+        # rendered before by another process or container
+        cached = persist.load_render(key)
+        if cached is not None:
+            cache.render_cache.put(key, cached)
+    return cached
+
+
+def render_png(diagram, max_height=None, output_format="png"):
+    """ PNG bytes and (width, height) for a parsed diagram, scaled down
+        to max_height if it's taller.  Exact matches come straight from
+        the pre-rendered bundle, the render cache or the persisted
+        renders (see persist.py), anything else waits for a slot in its
+        scheduler lane, output_format ("png" or "vssx") is part of the
+        cost.
+    """
+    prewarm.record_diagram(diagram, max_height)
+
+    key = "{}:{}".format(diagram.get_key(), max_height)
+    # a profiled render always renders, see profiler.py
+    if not diagram.profiling:
+        found = find_render(diagram, key, max_height)
+        if found is not None:
+            return found
+
+    with scheduler.slot(diagram, output_format):
+        img = scale_to_height(diagram.render(), max_height)
+        cancellation.check(diagram, "encode")
+        return encode_png(diagram, key, img)
+
+
+def encode_png(diagram, key, img):
+    """ PNG bytes and size of a rendered image, kept in the render cache
+        and persisted under key.
+    """
     buffered = BytesIO()
-    img = get_image_sync(params)
-    img.save(buffered, format="PNG")
-    return buffered
+    with metrics.encode_seconds.time(diagram.family):
+        img.save(buffered, format="PNG")
+    # the encoded png and the image are both alive here
+    diagram.record_memory()
+    result = (buffered.getvalue(), img.size)
+    cache.render_cache.put(key, result)
+    # written by a background thread, the caller doesn't wait on it
+    persist.save_render(key, result)
+    return result
+
+
+def render_png_fit(diagram, max_bytes, max_height=None, output_format="png"):
+    """ Like render_png, but the PNG is no bigger than max_bytes.  If the
+        normal PNG is too big a palette and/or smaller scale is chosen,
+        see budget.py.  Returns (png_bytes, (width, height), settings).
+    """
+    prewarm.record_diagram(diagram, max_height)
+
+    key = "{}:{}".format(diagram.get_key(), max_height)
+    fit_key = "{}:{}".format(key, max_bytes)
+    found = None
+    if not diagram.profiling:
+        found = find_render(diagram, key, max_height)
+        if found is not None and len(found[0]) <= max_bytes:
+            return found[0], found[1], budget.settings(found[1], False, 1.0)
+        cached = cache.render_cache.get(fit_key)
+        if cached is not None:
+            return cached
+
+    with scheduler.slot(diagram, output_format):
+        # one render for both the normal PNG and the fit
+        img = scale_to_height(diagram.render(), max_height)
+        cancellation.check(diagram, "encode")
+        if found is None:
+            found = encode_png(diagram, key, img)
+            if len(found[0]) <= max_bytes:
+                return found[0], found[1], budget.settings(found[1], False,
+                                                           1.0)
+            cancellation.check(diagram, "encode")
+        with metrics.encode_seconds.time(diagram.family):
+            result = budget.fit_png(img, max_bytes, found[0])
+        diagram.record_memory()
+    cache.render_cache.put(fit_key, result)
+    return result
+
+
+def get_image_bytes_png_sync(params):
+    diagram = get_diagram(params)
+    return BytesIO(render_png(diagram)[0])
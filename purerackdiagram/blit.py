@@ -0,0 +1,162 @@
+"""
+Compositing backends for pasting the same tile at many locations.
+
+The default "pillow" backend is a plain loop of Image.paste.  The
+optional "numpy" backend views the canvas and tiles as arrays and writes
+every evenly spaced row of a tile with one strided assignment, straight
+into the canvas' buffer when the image is a canvas view.  Both
+give pixel identical results.  If NumPy isn't installed the numpy
+backend falls back to pillow.
+
+Select the backend with the PURERACK_BLIT environment variable or
+set_backend().
+"""
+import logging
+import os
+from PIL import Image
+
+logger = logging.getLogger()
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+valid_backends = ["pillow", "numpy"]
+backend = "pillow"
+
+
+def set_backend(name):
+    global backend
+
+    name = name.lower()
+    if name not in valid_backends:
+        raise Exception("invalid blit backend: {}, valid backends: {}".format(
+            name, valid_backends))
+
+    if name == "numpy" and np is None:
+        logger.warning("numpy is not installed, using the pillow backend")
+        name = "pillow"
+    backend = name
+
+
+def paste_many(img, pastes):
+    """ Paste tiles onto img.
+        Args:
+            img: PIL image to paste onto, must not be a shared asset
+            pastes: list of (tile, (x, y)) in paste order, a later paste
+                    to the same location replaces the earlier one.
+        Returns img, with the tiles pasted.
+    """
+    if not pastes:
+        return img
+
+    if backend == "numpy":
+        return paste_many_numpy(img, pastes)
+
+    for tile, loc in pastes:
+        img.paste(tile, loc)
+    return img
+
+
+def group_runs(locs, tile_w):
+    """ Split locations into runs on the same row with a constant x step
+        at least as wide as the tile, so each run is one strided write.
+    """
+    runs = []
+    for loc in sorted(locs, key=lambda l: (l[1], l[0])):
+        if runs:
+            run = runs[-1]
+            last = run[-1]
+            if loc[1] == last[1]:
+                step = loc[0] - last[0]
+                if step >= tile_w and (len(run) == 1 or
+                                       step == run[1][0] - run[0][0]):
+                    run.append(loc)
+                    continue
+        runs.append([loc])
+    return runs
+
+
+def paste_many_numpy(img, pastes):
+    # last paste to a location wins, same as pasting in order
+    by_loc = {}
+    tiles = {}
+    for tile, loc in pastes:
+        by_loc.pop(loc, None)
+        by_loc[loc] = id(tile)
+        tiles[id(tile)] = tile
+
+    canvas = mapped_array(img)
+    in_place = canvas is not None
+    if not in_place:
+        canvas = np.array(img)
+    canvas_h, canvas_w = canvas.shape[:2]
+
+    locs_by_tile = {}
+    for loc, tile_id in by_loc.items():
+        locs_by_tile.setdefault(tile_id, []).append(loc)
+
+    for tile_id, locs in locs_by_tile.items():
+        tile = tiles[tile_id]
+        if tile.mode != img.mode:
+            tile = tile.convert(img.mode)
+        tile_arr = np.asarray(tile)
+        tile_h, tile_w = tile_arr.shape[:2]
+
+        for run in group_runs(locs, tile_w):
+            x0, y0 = run[0]
+            x_end = run[-1][0] + tile_w
+            fits = (x0 >= 0 and y0 >= 0 and
+                    x_end <= canvas_w and y0 + tile_h <= canvas_h)
+
+            if len(run) > 1 and fits:
+                # one strided view over every tile slot in the run
+                step = run[1][0] - x0
+                view = np.lib.stride_tricks.as_strided(
+                    canvas[y0:, x0:],
+                    shape=(tile_h, len(run), tile_w) + canvas.shape[2:],
+                    strides=(canvas.strides[0], canvas.strides[1] * step) +
+                    canvas.strides[1:],
+                    writeable=True)
+                view[...] = tile_arr[:, None]
+            else:
+                for x, y in run:
+                    blit_clipped(canvas, tile_arr, x, y)
+
+    if not in_place:
+        img.paste(Image.fromarray(canvas, img.mode))
+    return img
+
+
+def mapped_array(img):
+    """ Writable array over the pixels of a canvas view (see
+        utils.Canvas.view), None for any other image.
+    """
+    mapped = getattr(img, "mapped", None)
+    if mapped is None or img.mode not in ("RGB", "RGBA"):
+        return None
+    buf, offset, stride = mapped
+    width, height = img.size
+    # both modes are 4 bytes a pixel, RGB leaves the last one as padding
+    pixels = np.ndarray((height, width, 4), dtype=np.uint8, buffer=buf,
+                        offset=offset, strides=(stride, 4, 1))
+    return pixels if img.mode == "RGBA" else pixels[..., :3]
+
+
+def blit_clipped(canvas, tile_arr, x, y):
+    tile_h, tile_w = tile_arr.shape[:2]
+    canvas_h, canvas_w = canvas.shape[:2]
+
+    left = max(x, 0)
+    top = max(y, 0)
+    right = min(x + tile_w, canvas_w)
+    bottom = min(y + tile_h, canvas_h)
+    if left >= right or top >= bottom:
+        return
+
+    canvas[top:bottom, left:right] = \
+        tile_arr[top - y:bottom - y, left - x:right - x]
+
+
+set_backend(os.environ.get("PURERACK_BLIT", "pillow"))
@@ -0,0 +1,128 @@
+"""
+Fit a rendered image into a byte budget.
+
+Candidates are tried best first: full colour then a 256 colour palette,
+at each scale in scales.  Instead of encoding every candidate, sizes
+are estimated from cheap trial encodes and only the chosen candidate is
+encoded at full size, if the estimate was too low the next candidate is
+tried.
+
+    full scale palette: a sample of full resolution bands is encoded
+        both ways, the palette/full colour ratio is applied to the full
+        size encode the caller already has.
+    smaller scales: the image is encoded at 1/4 and 1/8 scale, the png
+        size is fitted as a power of the scale through the two and
+        interpolated.  Resampling adds detail that a png compresses
+        badly, so size isn't proportional to pixel count.
+"""
+import math
+from io import BytesIO
+from PIL import Image
+
+scales = [1.0, 0.75, 0.5, 0.35, 0.25, 0.15, 0.1]
+trial_scales = [0.25, 0.125]
+
+# estimates are aimed a bit under the budget so the real encode fits
+safety = 0.95
+
+
+def encode(img, palette, scale):
+    if scale != 1.0:
+        size = (max(1, int(img.size[0] * scale)),
+                max(1, int(img.size[1] * scale)))
+        img = img.resize(size, Image.ANTIALIAS)
+    if palette:
+        img = img.quantize(256, method=Image.FASTOCTREE)
+
+    buffered = BytesIO()
+    # palette images are small, the best compression is cheap
+    img.save(buffered, format="PNG", compress_level=9 if palette else 6)
+    return buffered.getvalue(), img.size
+
+
+def settings(img_size, palette, scale):
+    return {"scale": scale,
+            "mode": "P" if palette else "RGB",
+            "compress_level": 9 if palette else 6,
+            "size": img_size}
+
+
+def sample_bands(img, band=64, every=8):
+    """ Every 8th band of rows at full resolution, stacked. """
+    w, h = img.size
+    count = max(1, h // (band * every))
+    sample = Image.new(img.mode, (w, band * count))
+    for i in range(count):
+        y = i * h // count
+        sample.paste(img.crop((0, y, w, y + band)), (0, i * band))
+    return sample
+
+
+class Estimator():
+    def __init__(self, img, full_bytes):
+        self.img = img
+        self.full_bytes = full_bytes
+        self.palette_ratio = None
+        self.trials = None
+
+    def estimate(self, palette, scale):
+        if scale == 1.0:
+            if not palette:
+                return self.full_bytes
+            if self.palette_ratio is None:
+                sample = sample_bands(self.img)
+                self.palette_ratio = len(encode(sample, True, 1.0)[0]) / \
+                    float(len(encode(sample, False, 1.0)[0]))
+            return self.full_bytes * self.palette_ratio
+
+        if self.trials is None:
+            # the smaller trial comes from the larger one, it's much
+            # cheaper than resampling the full image again
+            large = self.img.resize(
+                (max(1, int(self.img.size[0] * trial_scales[0])),
+                 max(1, int(self.img.size[1] * trial_scales[0]))),
+                Image.ANTIALIAS)
+            step = trial_scales[1] / trial_scales[0]
+            self.trials = {}
+            for p in [False, True]:
+                self.trials[p] = (len(encode(large, p, 1.0)[0]),
+                                  len(encode(large, p, step)[0]))
+
+        large_bytes, small_bytes = self.trials[palette]
+        power = math.log(large_bytes / float(small_bytes)) / \
+            math.log(trial_scales[0] / trial_scales[1])
+        return large_bytes * (scale / trial_scales[0]) ** power
+
+
+def fit_png(img, max_bytes, full_png=None):
+    """ Best png of img no bigger than max_bytes.
+        Args:
+            img: rendered image
+            max_bytes: png size budget
+            full_png: img already encoded full colour at full scale,
+                      encoded here if not given
+        Returns (png_bytes, (width, height), settings dict)
+    """
+    if full_png is None:
+        full_png = encode(img, False, 1.0)[0]
+    if len(full_png) <= max_bytes:
+        return full_png, img.size, settings(img.size, False, 1.0)
+
+    estimator = Estimator(img, len(full_png))
+
+    # full colour at full scale is full_png, already too big
+    candidates = [(palette, scale) for scale in scales
+                  for palette in [False, True]][1:]
+    for palette, scale in candidates:
+        guess = estimator.estimate(palette, scale)
+        # the smallest is always tried, the estimate could be wrong
+        if guess > max_bytes * safety and \
+                (palette, scale) != candidates[-1]:
+            continue
+
+        png, size = encode(img, palette, scale)
+        if len(png) <= max_bytes:
+            return png, size, settings(size, palette, scale)
+
+    raise Exception("Diagram doesn't fit in {} bytes, even at {} scale "
+                    "with a palette".format(max_bytes, scales[-1]))
@@ -0,0 +1,210 @@
+"""
+Pre-rendered artifact bundle.
+
+A bundle is a zip file built ahead of time (see build_bundle.py) holding
+PNG renders of the common product matrix.  Each PNG is stored once
+under the sha256 of its bytes, and manifest.json maps each diagram's
+canonical key (Diagram.get_key()) to its object.
+
+The bundle is versioned against a hash of every input that can change
+the output: the PNG assets, config.json, the font and the render code.
+A bundle built from different inputs is ignored, and any miss just
+falls back to rendering.
+
+    python build_bundle.py -o purerackdiagram/bundle.zip
+    python build_bundle.py --requests requests.jsonl --top 200
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import zipfile
+from io import BytesIO
+import purerackdiagram
+from . import utils
+
+logger = logging.getLogger()
+
+bundle_path = os.environ.get("PURERACK_BUNDLE",
+                             os.path.join(utils.root_path, "bundle.zip"))
+bundle = None
+bundle_lock = threading.Lock()
+stats = {"hits": 0, "misses": 0}
+
+
+def asset_version():
+    """ Hash of every file that can change a rendered image. """
+    h = hashlib.sha256()
+    files = []
+    for dir_path, _, file_names in os.walk(utils.root_path):
+        for file_name in file_names:
+            if file_name.endswith((".png", ".json", ".ttf", ".py")):
+                files.append(os.path.join(dir_path, file_name))
+
+    for path in sorted(files):
+        h.update(os.path.relpath(path, utils.root_path).encode())
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class Bundle():
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, "r")
+        self.manifest = json.loads(self.zip.read("manifest.json"))
+        self.entries = self.manifest["entries"]
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        png = self.zip.read("objects/{}.png".format(entry["object"]))
+        return png, tuple(entry["size"])
+
+
+def get_bundle():
+    global bundle
+
+    with bundle_lock:
+        if bundle is None:
+            bundle = False
+            if os.path.exists(bundle_path):
+                loaded = Bundle(bundle_path)
+                if loaded.manifest["version"] == asset_version():
+                    bundle = loaded
+                    logger.info("Loaded bundle: {} with {} entries".format(
+                        bundle_path, len(loaded.entries)))
+                else:
+                    logger.warning("Ignoring stale bundle: {}".format(
+                        bundle_path))
+        return bundle
+
+
+def lookup(diagram):
+    """ Returns (png_bytes, (width, height)) for an exact match in the
+        bundle, or None so the caller renders it.
+    """
+    current = get_bundle()
+    found = None
+    if current:
+        found = current.lookup(diagram.get_key())
+
+    if found is None:
+        stats["misses"] += 1
+    else:
+        stats["hits"] += 1
+    return found
+
+
+def product_matrix():
+    """ Every model x datapacks x addon card x face x csize combination
+        we ship, the same matrix test.py test_all checks.
+    """
+    models = utils.global_config['pci_config_lookup']
+    dps = ['45/45-31/63-45', '3/127-24']
+    csizes = ['366', '879', '1390']
+    all_params = []
+
+    # front:
+    for model in models:
+        model = model[:8]
+        for dp_label in [True, False]:
+            if 'c' in model:
+                for csize in csizes:
+                    all_params.append({"model": model,
+                                       "fm_label": True,
+                                       "dp_label": dp_label,
+                                       "csize": csize})
+            else:
+                for dp in dps:
+                    all_params.append({"model": model,
+                                       "fm_label": True,
+                                       "dp_label": dp_label,
+                                       "datapacks": dp})
+
+    # back:
+    addon_cards = utils.global_config['pci_valid_cards']
+
+    for model in models:
+        model = model[:8]
+        for card in addon_cards:
+            if 'c' in model:
+                for csize in csizes:
+                    all_params.append({"model": model,
+                                       "addoncards": card,
+                                       "face": "back",
+                                       "csize": csize})
+            else:
+                for dp in dps:
+                    all_params.append({"model": model,
+                                       "datapacks": dp,
+                                       "addoncards": card,
+                                       "face": "back"})
+    return all_params
+
+
+def read_params_file(path):
+    """ JSONL of params, either bare params or lambda events. """
+    all_params = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            params = json.loads(line)
+            if "queryStringParameters" in params:
+                params = params["queryStringParameters"]
+            if params:
+                all_params.append(params)
+    return all_params
+
+
+def top_params(all_params, top):
+    """ The top N most requested diagrams by canonical key. """
+    counts = {}
+    first = {}
+    for params in all_params:
+        try:
+            key = purerackdiagram.get_diagram(dict(params)).get_key()
+        except Exception as e:
+            logger.warning("Skipping invalid params {}: {}".format(params, e))
+            continue
+        counts[key] = counts.get(key, 0) + 1
+        first.setdefault(key, params)
+
+    keys = sorted(counts, key=lambda k: counts[k], reverse=True)
+    if top:
+        keys = keys[:top]
+    return [first[k] for k in keys]
+
+
+def render_png(params):
+    diagram = purerackdiagram.get_diagram(dict(params))
+    img = diagram.render()
+    buffered = BytesIO()
+    img.save(buffered, format="PNG")
+    return diagram.get_key(), buffered.getvalue(), img.size
+
+
+def build(all_params, output, threads=1):
+    import concurrent.futures
+
+    entries = {}
+    objects = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for key, png, size in pool.map(render_png, all_params):
+            object_id = hashlib.sha256(png).hexdigest()
+            objects[object_id] = png
+            entries[key] = {"object": object_id, "size": list(size)}
+
+    manifest = {"version": asset_version(), "entries": entries}
+
+    # pngs are already compressed, no point deflating them again
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as zipf:
+        zipf.writestr("manifest.json", json.dumps(manifest))
+        for object_id, png in objects.items():
+            zipf.writestr("objects/{}.png".format(object_id), png)
+
+    return len(entries), len(objects)
+
@@ -0,0 +1,84 @@
+"""
+In-process caches shared by every diagram.
+
+component_cache holds built component images (FA chassis, shelves, FB
+chassis) keyed by utils.component_key(), the images are shared and must
+be treated as read-only.  They're the hardware only, the labels drawn
+over them are kept in label_cache as labels.Overlay objects.
+
+render_cache holds finished PNG bytes keyed by the diagram's canonical
+key, so a repeated request skips both rendering and encoding.
+
+All are LRUs bounded by bytes, sized with PURERACK_COMPONENT_CACHE_MB,
+PURERACK_LABEL_CACHE_MB and PURERACK_RENDER_CACHE_MB.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+
+class LRUCache():
+    def __init__(self, max_bytes, sizeof):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.items[key][0]
+            self.stats["misses"] += 1
+            return None
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            # would push everything else out, not worth caching
+            return
+
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items.pop(key)[1]
+            self.items[key] = (value, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.items.popitem(last=False)
+                self.bytes -= evicted_size
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.bytes = 0
+
+
+def image_bytes(img):
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+def png_bytes(value):
+    return len(value[0])
+
+
+component_cache = LRUCache(
+    int(os.environ.get("PURERACK_COMPONENT_CACHE_MB", 128)) * 1024 * 1024,
+    image_bytes)
+
+label_cache = LRUCache(
+    int(os.environ.get("PURERACK_LABEL_CACHE_MB", 16)) * 1024 * 1024,
+    lambda overlay: overlay.bytes)
+
+# values are (png_bytes, (width, height)), same as a bundle lookup
+render_cache = LRUCache(
+    int(os.environ.get("PURERACK_RENDER_CACHE_MB", 64)) * 1024 * 1024,
+    png_bytes)
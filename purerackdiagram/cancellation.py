@@ -0,0 +1,78 @@
+"""
+Cancellation of renders nobody is waiting for anymore.
+
+A CancelToken set on the diagram as diagram.cancel is checked at the
+render's boundaries: while it waits for a scheduler slot, before each
+component is built, before the components are composed and before the
+encode.  Once the token is cancelled the next check raises Cancelled
+and the rest of the render is skipped.  Components finished before that
+are already in the component cache, the next request for them doesn't
+build them again.
+
+server.py cancels a request's token when its client disconnects.  A
+token can also have a deadline: PURERACK_DEADLINE_S seconds (default 0,
+none) for every request, and for the lambda whatever is left of the
+invocation's time.  The work skipped is counted in the metrics by the
+stage it was skipped at.
+
+    token = cancellation.CancelToken(deadline=time.time() + 10)
+    diagram.cancel = token
+    render_png(diagram)    # raises Cancelled once the deadline passes
+"""
+import os
+import time
+from . import metrics
+
+deadline_s = float(os.environ.get("PURERACK_DEADLINE_S", 0))
+
+
+class Cancelled(Exception):
+    """ The render was cancelled, reason is "disconnect", "deadline" or
+        what the token was cancelled with.
+    """
+
+    def __init__(self, reason, stage):
+        Exception.__init__(self, "Render cancelled ({}) before {}".format(
+            reason, stage))
+        self.reason = reason
+        self.stage = stage
+
+
+class CancelToken():
+    def __init__(self, deadline=None):
+        # time.time() the render gives up at, None for no deadline
+        self.deadline = deadline
+        self.reason = None
+
+    @classmethod
+    def for_request(cls, remaining_s=None):
+        """ Token with the PURERACK_DEADLINE_S deadline, or remaining_s
+            from now if that comes sooner.
+        """
+        limits = [s for s in [deadline_s, remaining_s] if s]
+        return cls(time.time() + min(limits) if limits else None)
+
+    def cancel(self, reason="cancelled"):
+        # the first reason sticks
+        if self.reason is None:
+            self.reason = reason
+
+    @property
+    def cancelled(self):
+        if self.reason is None and self.deadline is not None and \
+                time.time() >= self.deadline:
+            self.cancel("deadline")
+        return self.reason is not None
+
+    def check(self, stage):
+        """ Raise Cancelled if the work about to start at stage isn't
+            wanted anymore, it's counted as saved.
+        """
+        if self.cancelled:
+            metrics.cancel_skipped.inc(stage)
+            raise Cancelled(self.reason, stage)
+
+
+def check(diagram, stage):
+    if diagram.cancel is not None:
+        diagram.cancel.check(stage)
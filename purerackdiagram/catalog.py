@@ -0,0 +1,324 @@
+"""
+Incremental catalog of rendered diagrams.
+
+Renders a list of params (the product matrix, a JSONL log or a matrix
+spec) in a process pool to a directory or zip, with a manifest.json.
+Every output records the asset files and config.json entries its render
+read, with their hashes.  A rerun compares those against the current
+files and config and only re-renders the outputs whose inputs changed,
+new params are rendered and params no longer listed are dropped.  Any
+change to the render code re-renders everything.
+
+    python build_catalog.py -o catalog/
+    python build_catalog.py spec.json -o catalog.zip -t 8
+"""
+import hashlib
+import itertools
+import json
+import logging
+import os
+import zipfile
+from io import BytesIO
+import purerackdiagram
+from . import bundle
+from . import cache
+from . import utils
+
+logger = logging.getLogger()
+
+
+class RecordingDict(dict):
+    """ config.json section that logs which entries are looked up. """
+
+    def __init__(self, name, values, log):
+        dict.__init__(self, values)
+        self.name = name
+        self.log = log
+
+    def __getitem__(self, key):
+        self.log.add("{}/{}".format(self.name, key))
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.log.add("{}/{}".format(self.name, key))
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self.log.add("{}/{}".format(self.name, key))
+        return dict.get(self, key, default)
+
+    def keys(self):
+        # listing the keys (error messages) depends on all of them
+        self.log.add(self.name)
+        return dict.keys(self)
+
+
+class RecordingList(list):
+    """ config.json list section, any use depends on the whole list. """
+
+    def __init__(self, name, values, log):
+        list.__init__(self, values)
+        self.name = name
+        self.log = log
+
+    def __contains__(self, value):
+        self.log.add(self.name)
+        return list.__contains__(self, value)
+
+    def __iter__(self):
+        self.log.add(self.name)
+        return list.__iter__(self)
+
+
+def code_version():
+    """ Hash of the render code, a change re-renders everything. """
+    h = hashlib.sha256()
+    for file_name in sorted(os.listdir(utils.root_path)):
+        if file_name.endswith(".py"):
+            h.update(file_name.encode())
+            with open(os.path.join(utils.root_path, file_name), "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def config_entry(name, config=None):
+    """ Current value of a recorded entry, "section" or "section/key". """
+    if config is None:
+        config = utils.global_config
+    section, _, key = name.partition("/")
+    value = config.get(section)
+    if key:
+        value = dict.get(value, key) if isinstance(value, dict) else None
+    return value
+
+
+def config_hash(name, config=None):
+    value = json.dumps(config_entry(name, config), sort_keys=True)
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def output_name(params):
+    parts = []
+    for key, value in sorted(params.items()):
+        value = str(value).replace("/", "-").replace(",", "+")
+        parts.append("{}-{}".format(key, value))
+    return "_".join(parts) + ".png"
+
+
+def expand_spec(spec):
+    """ Matrix spec {"model": [...], "face": [...]} to every combination,
+        a single value is used as is.
+    """
+    keys = sorted(spec)
+    values = [spec[k] if isinstance(spec[k], list) else [spec[k]]
+              for k in keys]
+    return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+
+
+def read_input(path):
+    """ Params to render: JSONL of params or lambda events, a JSON
+        matrix spec, or the product matrix when path is None.
+    """
+    if path is None:
+        return bundle.product_matrix()
+    if path.endswith(".jsonl"):
+        return bundle.read_params_file(path)
+    with open(path) as f:
+        return expand_spec(json.load(f))
+
+
+def init_worker():
+    # each output needs its full dependency list, so nothing may come
+    # out of a cache that was filled by an earlier render
+    for lru in [cache.component_cache, cache.label_cache]:
+        lru.max_bytes = 0
+        lru.clear()
+    utils.set_pool_size(1)
+
+    for name, section in list(utils.global_config.items()):
+        if isinstance(section, dict):
+            utils.global_config[name] = RecordingDict(name, section,
+                                                      config_log)
+        elif isinstance(section, list):
+            utils.global_config[name] = RecordingList(name, section,
+                                                      config_log)
+
+
+config_log = set()
+
+
+def render_entry(params):
+    """ Runs in a pool worker, renders params and returns the png with
+        the dependencies the render read.
+    """
+    config_log.clear()
+    utils.dependency_log = set()
+    try:
+        diagram = purerackdiagram.get_diagram(dict(params))
+        img = diagram.render()
+    except Exception as e:
+        return {"params": params, "error": str(e)}
+    finally:
+        assets = utils.dependency_log
+        utils.dependency_log = None
+
+    buffered = BytesIO()
+    img.save(buffered, format="PNG")
+
+    # sections that aren't dicts or lists (the blade pattern) can't be
+    # traced, every output depends on them
+    config = set(config_log)
+    for name, section in utils.global_config.items():
+        if not isinstance(section, (dict, list)):
+            config.add(name)
+
+    return {
+        "params": params,
+        "png": buffered.getvalue(),
+        "size": list(img.size),
+        "assets": {os.path.relpath(path, utils.root_path): file_hash(path)
+                   for path in assets},
+        "config": {name: config_hash(name) for name in config},
+    }
+
+
+class Output():
+    """ Writes the catalog to a directory, or a zip if the path ends
+        with .zip.  Unchanged files are carried over from the previous
+        zip.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_zip = path.endswith(".zip")
+        self.old_zip = None
+        if self.is_zip and os.path.exists(path):
+            self.old_zip = zipfile.ZipFile(path, "r")
+        self.files = {}
+
+    def read_manifest(self):
+        try:
+            if self.is_zip:
+                if self.old_zip is None:
+                    return None
+                return json.loads(self.old_zip.read("manifest.json"))
+            with open(os.path.join(self.path, "manifest.json")) as f:
+                return json.load(f)
+        except (KeyError, IOError, ValueError):
+            return None
+
+    def exists(self, name):
+        if self.is_zip:
+            return (self.old_zip is not None and
+                    name in self.old_zip.namelist())
+        return os.path.exists(os.path.join(self.path, name))
+
+    def keep(self, name):
+        if self.is_zip:
+            self.files[name] = self.old_zip.read(name)
+
+    def write(self, name, data):
+        if self.is_zip:
+            self.files[name] = data
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, name), "wb") as f:
+            f.write(data)
+
+    def remove(self, name):
+        if not self.is_zip and self.exists(name):
+            os.remove(os.path.join(self.path, name))
+
+    def close(self, manifest):
+        data = json.dumps(manifest, indent=1, sort_keys=True).encode()
+        if not self.is_zip:
+            self.write("manifest.json", data)
+            return
+
+        if self.old_zip is not None:
+            self.old_zip.close()
+        tmp_path = self.path + ".tmp"
+        # pngs are already compressed
+        with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as zipf:
+            zipf.writestr("manifest.json", data)
+            for name, file_data in sorted(self.files.items()):
+                zipf.writestr(name, file_data)
+        os.replace(tmp_path, self.path)
+
+
+def is_current(entry, params, version, file_hashes):
+    if entry is None or entry.get("params") != params:
+        return False
+    if entry.get("code") != version:
+        return False
+
+    for rel_path, digest in entry["assets"].items():
+        if rel_path not in file_hashes:
+            path = os.path.join(utils.root_path, rel_path)
+            file_hashes[rel_path] = \
+                file_hash(path) if os.path.exists(path) else None
+        if file_hashes[rel_path] != digest:
+            return False
+
+    for name, digest in entry["config"].items():
+        if config_hash(name) != digest:
+            return False
+    return True
+
+
+def build(all_params, output_path, processes=None, force=False):
+    """ Render everything that's missing or stale.  Returns counts of
+        rendered, unchanged, removed and failed outputs.
+    """
+    import multiprocessing
+
+    output = Output(output_path)
+    old = output.read_manifest() or {"outputs": {}}
+    version = code_version()
+
+    outputs = {}
+    todo = {}
+    file_hashes = {}
+    counts = {"rendered": 0, "unchanged": 0, "removed": 0, "failed": 0}
+    for params in all_params:
+        name = output_name(params)
+        entry = old["outputs"].get(name)
+        if not force and output.exists(name) and \
+                is_current(entry, params, version, file_hashes):
+            outputs[name] = entry
+            output.keep(name)
+            counts["unchanged"] += 1
+        else:
+            todo[name] = params
+
+    if todo:
+        with multiprocessing.Pool(processes=processes,
+                                  initializer=init_worker) as pool:
+            for result in pool.imap_unordered(render_entry, todo.values()):
+                name = output_name(result["params"])
+                if "error" in result:
+                    logger.warning("Failed {}: {}".format(
+                        name, result["error"]))
+                    counts["failed"] += 1
+                    continue
+
+                png = result.pop("png")
+                output.write(name, png)
+                result["code"] = version
+                result["sha256"] = hashlib.sha256(png).hexdigest()
+                outputs[name] = result
+                counts["rendered"] += 1
+
+    for name in old["outputs"]:
+        if name not in outputs:
+            output.remove(name)
+            counts["removed"] += 1
+
+    output.close({"outputs": outputs})
+    return counts
@@ -1,10 +1,11 @@
 from PIL import Image
 from PIL import ImageDraw
-from PIL import ImageFont
 # from io import BytesIO
-import asyncio
 from . import utils
-from .utils import RackImage, combine_images_vertically
+from . import blit
+from . import labels
+from . import memory
+from .utils import RackImage
 # import logging
 import os
 from pprint import pformat
@@ -16,126 +17,109 @@ ttf_path = os.path.join(root_path, "Lato-Regular.ttf")
 class FAShelf():
     def __init__(self, params):
         self.config = params
-        self.start_img_event = asyncio.Event()
 
-    # Called externally to retrieve the image of the shelf
-    async def get_image(self):
+    def build(self, target=None):
         c = self.config
-        tasks = []
-        tasks.append(self.get_base_img())
+        self.get_base_img(target)
         if c["face"] == "front":
-            if c["shelf_type"] == "nvme":
-                tasks.append(self.add_nvme_fms())
-            else:
-                tasks.append(self.add_sas_fms())
-
-        # load the base image and FMs simultaniously.
-        await asyncio.gather(*tasks)
+            self.add_fms()
         return self.tmp_img
 
-    # load the first base image
-    async def get_base_img(self):
+    def base_key(self):
         c = self.config
-        key = "png/pure_fa_{}_shelf_{}.png".format(c["shelf_type"], c["face"])
-        self.tmp_img = await RackImage(key).get_image()
-        self.start_img_event.set()
+        return "png/pure_fa_{}_shelf_{}.png".format(c["shelf_type"], c["face"])
+
+    # load the first base image, into target when drawing on a canvas
+    def get_base_img(self, target=None):
+        self.tmp_img = utils.base_image(self.base_key(), target)
+
+    def get_fm_layout(self):
+        """ (fm_type, fm_str, (x, y), rotated) of every FM, in paste
+            order.
+        """
+        if self.config["shelf_type"] == "nvme":
+            return self.nvme_fm_layout()
+        return self.sas_fm_layout()
 
-    async def add_nvme_fms(self):
+    def nvme_fm_layout(self):
         cur_module = 0
+        layout = []
+        fm_loc = get_chassis_fm_loc()
 
         for dp in self.config["datapacks"]:
             fm_str = dp[0]
             fm_type = dp[1]
-            img_name = 'png/pure_fa_fm_{}.png'.format(fm_type)
             num_modules = dp[2]
 
             if fm_str == 'Blank':
                 num_modules = 14
 
-            fm_img = await RackImage(img_name).get_image()
-
-            if self.config['fm_label']:
-                apply_fm_label(fm_img, fm_str, fm_type)
-
-            # wait until the base image is loaded
-            await self.start_img_event.wait()
-            fm_loc = get_chassis_fm_loc()
-            fm_rotated = fm_img.rotate(-90, expand=True)
-
+            # the last 8 bays are turned on their side
             for x in range(cur_module, min(28, num_modules + cur_module)):
-                if x < 20:
-                    self.tmp_img.paste(fm_img, fm_loc[x])
-                else:
-                    self.tmp_img.paste(fm_rotated, fm_loc[x])
+                layout.append((fm_type, fm_str, fm_loc[x], x >= 20))
             cur_module += num_modules
+        return layout
 
-        # add datapack labels
-        right = False
-        if self.config['dp_label']:
-            for dp in self.config["datapacks"]:
-                num_modules = dp[2]
-                full = False
-                if num_modules == 28:
-                    full = True
-                dp_size = dp[3]
-                y_offset = 50
-                x_offset = 162
-                self.tmp_img = apply_dp_label(self.tmp_img,
-                                              dp_size,
-                                              x_offset,
-                                              y_offset,
-                                              right,
-                                              full)
-                right = True
-
-    async def add_sas_fms(self):
+    def sas_fm_layout(self):
         cur_module = 0
+        layout = []
+        fm_loc = get_sas_fm_loc()
+
         for dp in self.config["datapacks"]:
             fm_str = dp[0]
             fm_type = dp[1]
             num_modules = dp[2]
             if fm_type == 'blank':
                 num_modules = 12
-            dp_size = dp[3]
-            fm_img_str = "png/pure_fa_fm_{}.png".format(fm_type)
-            fm_img = await RackImage(fm_img_str).get_image()
-
-            if self.config['fm_label']:
-                apply_fm_label(fm_img, fm_str, fm_type)
-
-            await self.start_img_event.wait()
-            fm_loc = get_sas_fm_loc()
 
             for x in range(cur_module, min(24, cur_module + num_modules)):
-                self.tmp_img.paste(fm_img, fm_loc[x])
-            
+                layout.append((fm_type, fm_str, fm_loc[x], False))
+
             cur_module += num_modules
+        return layout
+
+    def add_fms(self):
+        pastes = []
+        rotated = {}
+        for fm_type, fm_str, loc, rotate in self.get_fm_layout():
+            fm_img = get_fm_img(fm_type)
+            if rotate:
+                if fm_type not in rotated:
+                    rotated[fm_type] = fm_img.rotate(-90, expand=True)
+                fm_img = rotated[fm_type]
+            pastes.append((fm_img, loc))
+
+        self.tmp_img = blit.paste_many(self.tmp_img, pastes)
+
+    def has_labels(self):
+        c = self.config
+        return c["face"] == "front" and (c["fm_label"] or c["dp_label"])
 
+    def get_labels(self):
+        c = self.config
+        overlay = labels.Overlay(memory.asset_info(self.base_key())[0])
+        if c["fm_label"]:
+            add_fm_labels(overlay, self.get_fm_layout())
 
-        # apply dp label after fm modules
-        right = False
-        if self.config['dp_label']:
-            for dp in self.config["datapacks"]:
-                fm_str = dp[0]
-                fm_type = dp[1]
+        # datapack labels go over the fm labels
+        if c["dp_label"]:
+            if c["shelf_type"] == "nvme":
+                x_offset, y_offset, bays = 162, 50, 28
+            else:
+                x_offset, y_offset, bays = 90, 0, 24
+
+            right = False
+            for dp in c["datapacks"]:
                 num_modules = dp[2]
                 dp_size = dp[3]
-                
-                y_offset = 0
-                x_offset = 90
-                full = False
-                if num_modules == 24:
-                    full = True
-
-                self.tmp_img = apply_dp_label(self.tmp_img,
+                overlay.patch(*dp_label_patch(overlay.size,
                                               dp_size,
                                               x_offset,
                                               y_offset,
                                               right,
-                                              full)
+                                              num_modules == bays))
                 right = True
-
-            
+        return overlay
 
 
 class FAChassis():
@@ -144,40 +128,39 @@ class FAChassis():
         config = params.copy()
         del config["shelves"]
         self.config = config
-        self.start_img_event = asyncio.Event()
         self.ch0_fm_loc = None
 
-    async def get_image(self):
+    def base_key(self):
         c = self.config
         key = "png/pure_fa_{}".format(c["generation"])
+        if c["face"] == "front" and c["bezel"]:
+            return key + "_bezel.png"
+        return key + "_{}.png".format(c["face"])
+
+    def build(self, target=None):
+        c = self.config
+        key = self.base_key()
 
         if c["face"] == "front" and c["bezel"]:
-            key += "_bezel.png"
-            return await RackImage(key).get_image()
+            return RackImage(key).get_image_sync()
 
         # not doing bezel
-        key += "_{}.png".format(c["face"])
-
-        tasks = []
-        tasks.append(self.get_base_img(key))
+        self.get_base_img(key, target)
 
         if c["face"] == "front":
-            tasks.append(self.add_fms())
-            tasks.append(self.add_nvram())
-            tasks.append(self.add_model_text())
+            self.add_fms()
+            self.add_nvram()
+            self.add_model_text()
         else:
-            tasks.append(self.add_cards())
-            tasks.append(self.add_mezz())
+            self.add_cards()
+            self.add_mezz()
 
-        # run all the tasks concurrently
-        await asyncio.gather(*tasks)
         return self.tmp_img
 
-    async def get_base_img(self, key):
-        self.tmp_img = await RackImage(key).get_image()
-        self.start_img_event.set()
+    def get_base_img(self, key, target=None):
+        self.tmp_img = utils.base_image(key, target)
 
-    async def add_nvram(self):
+    def add_nvram(self):
         if self.config['generation'] == 'x' or \
            self.config['generation'] == 'c':
             nv1 = (1263, 28)
@@ -193,21 +176,18 @@ class FAChassis():
             # Don't add second nvram on less  than 70
             return
 
-        nvram_img = await RackImage("png/pure_fa_x_nvram.png").get_image()
-        await self.start_img_event.wait()
+        nvram_img = RackImage("png/pure_fa_x_nvram.png").get_image_sync()
         self.tmp_img.paste(nvram_img, nv1)
         self.tmp_img.paste(nvram_img, nv2)
 
-    async def add_cards(self):
+    def add_cards(self):
         pci = self.config["pci_config"]
 
-        tasks = []
         for x in range(4):
             if pci[x]:
-                tasks.append(self.add_card(x, pci[x]))
-        await asyncio.gather(*tasks)
+                self.add_card(x, pci[x])
 
-    async def add_card(self, slot, card_type):
+    def add_card(self, slot, card_type):
         # y offset from CT1 -> CT0
         y_offset = 378
         if self.config['generation'] == 'x' or \
@@ -222,20 +202,18 @@ class FAChassis():
             height = "hh"
 
         key = "png/pure_fa_{}_{}.png".format(card_type, height)
-        card_img = await RackImage(key).get_image()
-        await self.start_img_event.wait()
+        card_img = RackImage(key).get_image_sync()
         cord = pci_loc[slot]
         self.tmp_img.paste(card_img, cord)
         ct0_cord = (cord[0], cord[1] + y_offset)
         self.tmp_img.paste(card_img, ct0_cord)
 
-    async def add_mezz(self):
+    def add_mezz(self):
         # if self.config["generation"] != "x" or self.config['mezz'] is None:
         #    return
         if self.config['mezz']:
             key = "png/pure_fa_x_{}.png".format(self.config["mezz"])
-            mezz_img = await RackImage(key).get_image()
-            await self.start_img_event.wait()
+            mezz_img = RackImage(key).get_image_sync()
             if self.config['generation'] == 'x' or \
                self.config['generation'] == 'c':
                 self.tmp_img.paste(mezz_img, (585, 45))
@@ -244,38 +222,31 @@ class FAChassis():
                 self.tmp_img.paste(mezz_img, (709, 44))
                 self.tmp_img.paste(mezz_img, (709, 421))
 
-    async def add_fms(self):
+    def get_fm_layout(self):
+        """ (fm_type, fm_str, (x, y), rotated) of every FM, in paste
+            order.
+        """
         # is  this the right side data pack ?
         # starts with no, then we change to yes after first one
         right = False
         slots = {}
+        layout = []
+        fm_loc = get_chassis_fm_loc(self.config['generation'])
+
         for dp in self.config["chassis_datapacks"]:
             fm_str = dp[0]
             fm_type = dp[1]
             num_modules = dp[2]
-            dp_size = dp[3]
-
-            file_name = "png/pure_fa_fm_{}.png".format(fm_type)
-            fm_img = await RackImage(file_name).get_image()
-            blank_img = await RackImage("png/pure_fa_fm_blank.png").get_image()
 
-            if self.config['fm_label']:
-                apply_fm_label(fm_img, fm_str, fm_type)
-                apply_fm_label(blank_img, "", "blank")
-
-            await self.start_img_event.wait()
             if not right:
                 the_range = range(0, num_modules)
             else:
                 the_range = reversed(range(20-num_modules, 20))
 
-            fm_loc = get_chassis_fm_loc(self.config['generation'])
-
             for x in the_range:
-                # self.tmp_img.save("tmp.png")
                 if not right and x >= num_modules:
                     # for short DMM modules, fill the rest with blanks
-                    self.tmp_img.paste(blank_img, fm_loc[x])
+                    layout.append(("blank", "", fm_loc[x], False))
                 else:
                     
                     if x in slots and slots[x] != "blank":
@@ -284,99 +255,148 @@ class FAChassis():
                         else:
                             raise Exception("Overlapping datapacks, check data pack sizes dont exceed chassis size of 20.")
                     else:                    
-                        self.tmp_img.paste(fm_img, fm_loc[x])
+                        layout.append((fm_type, fm_str, fm_loc[x], False))
                         # keep track of modules, to detect overlaps
                         slots[x] = fm_type
             
             right = True
+        return layout
 
+    def add_fms(self):
+        pastes = [(get_fm_img(fm_type), loc)
+                  for fm_type, _, loc, _ in self.get_fm_layout()]
+        self.tmp_img = blit.paste_many(self.tmp_img, pastes)
+
+    def has_labels(self):
+        c = self.config
+        return c["face"] == "front" and not c["bezel"] and \
+            (c["fm_label"] or c["dp_label"])
+
+    def get_labels(self):
+        c = self.config
+        overlay = labels.Overlay(memory.asset_info(self.base_key())[0])
+        if c["fm_label"]:
+            add_fm_labels(overlay, self.get_fm_layout())
 
-        
-        if self.config['dp_label']:
+        # datapack labels go over the fm labels
+        if c["dp_label"]:
             right = False
-            for dp in self.config["chassis_datapacks"]:
-                fm_str = dp[0]
-                fm_type = dp[1]
+            for dp in c["chassis_datapacks"]:
                 num_modules = dp[2]
                 dp_size = dp[3]
-
-                y_offset = 244
-                x_offset = 130
-                full = False
-                if num_modules == 20:
-                    full = True
-
-                self.tmp_img = apply_dp_label(self.tmp_img,
+                overlay.patch(*dp_label_patch(overlay.size,
                                               dp_size,
-                                              x_offset,
-                                              y_offset,
+                                              130,
+                                              244,
                                               right,
-                                              full)
+                                              num_modules == 20))
                 # the next DP must be the right side.
                 right = True
+        return overlay
 
-    async def add_model_text(self):
-        global ttf_path
-
+    def add_model_text(self):
         if self.config['generation'] == 'x' or \
            self.config['generation'] == 'c':
             loc = (2759, 83)
         else:
             loc = (2745, 120)
 
-        await self.start_img_event.wait()
         c = self.config
         draw = ImageDraw.Draw(self.tmp_img)
 
-        font = ImageFont.truetype(ttf_path, size=24)
+        font = utils.get_font(24)
         text = "{}{}r{}".format(c['generation'].upper(),
                                 c['model_num'],
                                 c['release'])
         draw.text(loc, text, (255, 255, 255, 220), font=font)
 
 
-def apply_fm_label(fm_img, fm_str, fm_type):
-    # writing flash module text lables
-    utils.apply_text_centered(fm_img, fm_str, 18)
-    utils.apply_text_centered(fm_img, fm_type, 32)
+def get_fm_img(fm_type):
+    """ FM tile, the shared read-only asset, labels are an overlay. """
+    return RackImage("png/pure_fa_fm_{}.png".format(fm_type)).get_image_sync()
 
 
-def apply_dp_label(img, dp_size, x_offset, y_offset, right, full=False):
-    global ttf_path
-    # temp image same size as our chassis.
-    tmp = Image.new('RGBA', img.size, (0, 0, 0, 0))
+def get_fm_labels(fm_type, fm_str, rotated=False):
+    """ Overlay of an FM tile's labels, turned with the tile when it's
+        on its side.
+    """
+    def build():
+        if rotated:
+            return get_fm_labels(fm_type, fm_str).rotated()
+        asset = "png/pure_fa_fm_{}.png".format(fm_type)
+        overlay = labels.Overlay(memory.asset_info(asset)[0])
+        apply_fm_label(overlay, fm_str, fm_type)
+        return overlay
 
-    # Create a drawing context for it.
-    draw = ImageDraw.Draw(tmp)
+    key = utils.component_key("fa_fm_labels", [fm_type, fm_str, rotated])
+    return labels.get_overlay(key, build)
+
+
+def add_fm_labels(overlay, fm_layout):
+    # an FM pasted over another covers its labels too
+    placed = {}
+    for fm_type, fm_str, loc, rotated in fm_layout:
+        placed[loc] = get_fm_labels(fm_type, fm_str, rotated)
+    for loc, fm_labels in placed.items():
+        overlay.extend(fm_labels, loc)
 
+
+def apply_fm_label(overlay, fm_str, fm_type):
+    # writing flash module text lables
+    x_loc = overlay.size[0] // 2
+    overlay.text(fm_str, x_loc, 18)
+    overlay.text(fm_type, x_loc, 32)
+
+
+def dp_label_patch(size, dp_size, x_offset, y_offset, right, full=False):
+    """ The datapack label for a component of size, as the RGBA patch
+        that's alpha composited over it and its (x, y).  The patch only
+        covers the box and the text, clipped to the component.
+    """
     x_buffer = 75
     y_buffer = 60
 
     box_loc = (x_offset + x_buffer, y_offset + y_buffer)
 
     if right:
-        box_loc = (tmp.size[0] // 2 + x_buffer, y_offset + y_buffer)
+        box_loc = (size[0] // 2 + x_buffer, y_offset + y_buffer)
 
     
-    box_size = (tmp.size[0] // 2 - 2 * x_buffer - x_offset,
-                (tmp.size[1] - 2 * y_buffer - y_offset))
+    box_size = (size[0] // 2 - 2 * x_buffer - x_offset,
+                (size[1] - 2 * y_buffer - y_offset))
     if full:
-        box_size = (tmp.size[0] - 2 * x_buffer - 2 * x_offset,
-                (tmp.size[1] - 2 * y_buffer - y_offset))
+        box_size = (size[0] - 2 * x_buffer - 2 * x_offset,
+                (size[1] - 2 * y_buffer - y_offset))
 
     # put DP on left or right
     box_loc2 = (box_loc[0]+box_size[0], box_loc[1]+box_size[1])
 
-    draw.rectangle((box_loc, box_loc2), fill=(199, 89, 40, 127))
     box_center = ((box_loc[0] + box_loc2[0]) // 2,
                   (box_loc[1] + box_loc2[1]) // 2)
-    font = ImageFont.truetype(ttf_path, size=85)
-    w, h = draw.textsize(dp_size+"TB", font=font)
+    font = utils.get_font(85)
+    text = dp_size + "TB"
+    w, h = font.getsize(text)
     text_loc = (box_center[0] - w/2, box_center[1] - h/2)
-    draw.text(text_loc, dp_size + "TB", fill=(255, 255, 255, 220), font=font)
 
-    alpha_tmp = img.convert("RGBA")
-    return Image.alpha_composite(alpha_tmp, tmp)
+    # the box (drawn inclusive) and the text, clipped to the image
+    text_box = font.getbbox(text)
+    region = (max(0, min(box_loc[0], int(text_loc[0] + text_box[0]))),
+              max(0, min(box_loc[1], int(text_loc[1] + text_box[1]))),
+              min(size[0], max(box_loc2[0] + 1,
+                               int(text_loc[0] + text_box[2]) + 2)),
+              min(size[1], max(box_loc2[1] + 1,
+                               int(text_loc[1] + text_box[3]) + 2)))
+    origin = region[:2]
+
+    tmp = Image.new('RGBA', (region[2] - region[0], region[3] - region[1]),
+                    (0, 0, 0, 0))
+    draw = ImageDraw.Draw(tmp)
+    draw.rectangle(((box_loc[0] - origin[0], box_loc[1] - origin[1]),
+                    (box_loc2[0] - origin[0], box_loc2[1] - origin[1])),
+                   fill=(199, 89, 40, 127))
+    draw.text((text_loc[0] - origin[0], text_loc[1] - origin[1]), text,
+              fill=(255, 255, 255, 220), font=font)
+    return tmp, origin
 
 
 # x,y coordinates for all chassis fms.
@@ -432,8 +452,13 @@ def get_sas_fm_loc():
     return fm_loc
 
 
-class FADiagram():
-    
+# drawn as an overlay, not part of a component's hardware
+label_options = ["fm_label", "dp_label"]
+
+
+class FADiagram(utils.Diagram):
+    family = "fa"
+
     def _init_pci_cards(self, config, params):
         pci_valid_cards = utils.global_config['pci_valid_cards']
         pci_config_lookup = utils.global_config['pci_config_lookup']
@@ -625,10 +650,10 @@ class FADiagram():
             config["fm_label"] = params.get("fm_label", False)
             config["dp_label"] = params.get("dp_label", False)
             config["bezel"] = params.get("bezel", False)
-            # check for string versions of no/false
+            # check for string versions of no/false, stored as a real
+            # bool so equivalent params give the same config
             for item in ["fm_label", 'dp_label', 'bezel']:
-                if config[item] in ['False', 'false', 'FALSE', 'no', '0', '']:
-                    config[item] = False
+                config[item] = utils.is_true(config[item])
 
         if config['generation'] == 'c':
             csize_lookup = utils.global_config['csize_lookup']
@@ -642,23 +667,58 @@ class FADiagram():
 
         # need for both as shelf type is encoded in DP sizes
         self._init_datapacks(config, params)
+        if face == "front":
+            # the fm layout loads nothing, overlapping datapacks fail here
+            # with the other bad params instead of in the render
+            FAChassis(config).get_fm_layout()
         self.config = config
 
-    async def get_image(self):
-        tasks = []
-
-
-        tasks.append(FAChassis(self.config).get_image())
-
+    def get_components(self):
+        # chassis and shelves build in parallel in the worker pool,
+        # identical shelves are only built once.  Labels are drawn over
+        # them, the keys are the hardware only.
+        chassis = FAChassis(self.config)
+        # ru and direction depend on the shelves, not the chassis image
+        chassis_key = {k: v for k, v in chassis.config.items()
+                       if k not in ["ru", "direction"] + label_options}
+        components = [(utils.component_key("fa_chassis", chassis_key),
+                       chassis.build)]
         for shelf in self.config["shelves"]:
-            tasks.append(FAShelf(shelf).get_image())
-
-
-        # go get the cached versions or build images
-        # this returns the results of the all the tasks in a list
-        all_images = await asyncio.gather(*tasks)
-
-        if self.config["direction"] == "up":
-            all_images.reverse()
-
-        return combine_images_vertically(all_images)
+            shelf_key = {k: v for k, v in shelf.items()
+                         if k not in label_options}
+            components.append((utils.component_key("fa_shelf", shelf_key),
+                               FAShelf(shelf).build))
+        return components
+
+    def estimate_size(self):
+        sizes = [memory.asset_info(FAChassis(self.config).base_key())[0]]
+        sizes += [memory.asset_info(FAShelf(shelf).base_key())[0]
+                  for shelf in self.config["shelves"]]
+        return max(w for w, _ in sizes), sum(h for _, h in sizes)
+
+    def get_component_assets(self):
+        # the chassis and shelves are the size of their base images
+        return [(key, builder.__self__.base_key())
+                for key, builder in self.get_components()]
+
+    def get_component_names(self):
+        return ["chassis"] + ["shelf{}".format(i + 1)
+                              for i in range(len(self.config["shelves"]))]
+
+    def get_component_ru(self):
+        # the same heights _init_datapacks adds up to config["ru"]
+        return [3] + [3 if shelf["shelf_type"] == "nvme" else 2
+                      for shelf in self.config["shelves"]]
+
+    def get_component_labels(self):
+        overlays = []
+        for key, builder in self.get_components():
+            component = builder.__self__
+            if component.has_labels():
+                label_key = utils.component_key(
+                    "fa_labels", [key] + [component.config[option]
+                                          for option in label_options])
+                overlays.append((label_key, component.get_labels))
+            else:
+                overlays.append(None)
+        return overlays
@@ -1,11 +1,13 @@
-import asyncio
+import functools
 import re
-import os
-from PIL import ImageDraw
-from PIL import ImageFont
-from .utils import RackImage, combine_images_vertically, global_config, apply_text
+from .utils import RackImage, global_config
+from .utils import Diagram, component_key, is_true
+from .labels import Overlay
+from . import memory
+
+class FBDiagram(Diagram):
+    family = "fb"
 
-class FBDiagram():
     def __init__(self, params):
         
         config = {}
@@ -47,7 +49,8 @@ class FBDiagram():
                         start = int(b_range)
                         end = start + 1
                     
-                    for i in range(start, end):
+                    # blades past the last chassis are never drawn
+                    for i in range(start, min(end, config["chassis"] * 15)):
                         blade_labels[i] = item_split[0]
         config['blade_labels'] = blade_labels
 
@@ -62,55 +65,117 @@ class FBDiagram():
 
 
         for item in ["xfm"]:
-            if config[item] in ['False','false','FALSE','no','0','']:
-                config[item] = False
+            config[item] = is_true(config[item])
 
         if config['xfm']:
             config['ru'] += 2
         
         self.config = config
 
-    async def build_chassis(self, number):
-        face = self.config["face"]
-        if face == 'front':
-            img_key = "png/pure_fb_front.png"
-        else:
-            img_key = "png/pure_fb_back_{}.png".format(self.config['efm'])
-
-        img = await RackImage(img_key).get_image()
-
-        if face == "front":
-            blade_index_offset = number * 15
-            x_offset = 260
-            x_blade_size = 164
-            y_offset = 967
-            for index in range(15):
-                blade_num = index + blade_index_offset
-                if blade_num in self.config['blade_labels']:
-                    label = self.config['blade_labels'][blade_num]
-                    label = "{} TB".format(label)
-                    apply_text(img, label, x_offset + x_blade_size*index, y_offset, 36)                
+    def chassis_asset(self):
+        if self.config["face"] == 'front':
+            return "png/pure_fb_front.png"
+        return "png/pure_fb_back_{}.png".format(self.config['efm'])
+
+    def build_chassis(self, number, target=None):
+        # the blade labels are an overlay, so the chassis is never drawn
+        # on and can share the cached asset
+        return RackImage(self.chassis_asset()).get_image_sync()
+
+    def get_blade_labels(self, number):
+        blade_index_offset = number * 15
+        x_offset = 260
+        x_blade_size = 164
+        y_offset = 967
+
+        # long labels can run into the next blade, they're drawn in
+        # order so the overlap comes out the same
+        overlay = Overlay(memory.asset_info(self.chassis_asset())[0])
+        for index in range(15):
+            blade_num = index + blade_index_offset
+            if blade_num in self.config['blade_labels']:
+                label = self.config['blade_labels'][blade_num]
+                label = "{} TB".format(label)
+                x_loc = x_offset + x_blade_size*index
+                overlay.text(label, x_loc, y_offset, 36)
+        return overlay
+
+    def xfm_asset(self):
+        return 'png/pure_fb_xfm_{}.png'.format(self.config["face"])
+
+    def get_xfm(self, target=None):
+        return RackImage(self.xfm_asset()).get_image_sync()
+
+    def chassis_key(self, number):
+        # every chassis is the same hardware, only the blade labels
+        # drawn over the front differ
+        key = {"face": self.config["face"]}
+        if self.config["face"] != "front":
+            key["efm"] = self.config["efm"]
+        return component_key("fb_chassis", key)
+
+    def chassis_labels(self, number):
+        blade_index_offset = number * 15
+        return [self.config["blade_labels"].get(index)
+                for index in range(blade_index_offset,
+                                   blade_index_offset + 15)]
+
+    def get_components(self):
+        # each chassis builds in parallel in the worker pool, chassis
+        # with identical labels (every back chassis) are built once.
+        components = []
+        for i in range(self.config["chassis"]):
+            components.append((self.chassis_key(i),
+                               functools.partial(self.build_chassis, i)))
 
-        return img
+        if self.config['xfm']:
+            xfm_key = component_key("fb_xfm", self.config["face"])
+            components.append((xfm_key, self.get_xfm))
+            components.append((xfm_key, self.get_xfm))
+        return components
 
+    def get_component_labels(self):
+        overlays = []
+        for i in range(self.config["chassis"]):
+            labels = self.chassis_labels(i)
+            if self.config["face"] == "front" and any(labels):
+                overlays.append((component_key("fb_labels", labels),
+                                 functools.partial(self.get_blade_labels,
+                                                   i)))
+            else:
+                overlays.append(None)
+        if self.config['xfm']:
+            overlays += [None, None]
+        return overlays
 
-    async def get_image(self):
-        tasks = []
+    def estimate_size(self):
+        # every chassis is the same size, no need to list them
+        width, height = memory.asset_info(self.chassis_asset())[0]
+        height *= self.config["chassis"]
+        if self.config['xfm']:
+            xfm_width, xfm_height = memory.asset_info(self.xfm_asset())[0]
+            width = max(width, xfm_width)
+            height += 2 * xfm_height
+        return width, height
+
+    def get_component_names(self):
+        # chassis1 has blades 0-14
+        names = ["chassis{}".format(i + 1)
+                 for i in range(self.config["chassis"])]
+        if self.config['xfm']:
+            names += ["xfm1", "xfm2"]
+        return names
 
+    def get_component_ru(self):
+        ru = [4] * self.config["chassis"]
+        if self.config['xfm']:
+            ru += [1, 1]
+        return ru
 
-        for i in range(self.config["chassis"]):
-            tasks.append(self.build_chassis(i))
-        
+    def get_component_assets(self):
+        assets = [(self.chassis_key(i), self.chassis_asset())
+                  for i in range(self.config["chassis"])]
         if self.config['xfm']:
-            tasks.append(
-                RackImage('png/pure_fb_xfm_{}.png'.format(self.config["face"])).
-                            get_image())
-            tasks.append(
-                RackImage('png/pure_fb_xfm_{}.png'.format(self.config["face"])).
-                            get_image())
-
-        all_images = await asyncio.gather(*tasks)
-        if self.config["direction"] == "up":
-            all_images.reverse()
-
-        return combine_images_vertically(all_images)
\ No newline at end of file
+            xfm_key = component_key("fb_xfm", self.config["face"])
+            assets += [(xfm_key, self.xfm_asset())] * 2
+        return assets
@@ -0,0 +1,118 @@
+"""
+Label overlays.
+
+FM labels, datapack labels and FlashBlade blade labels are an overlay
+drawn over a component after its hardware is built.  The hardware is
+cached without its labels (component_cache) and the overlay separately
+(label_cache), so turning fm_label or dp_label on or off, or changing
+the blades, reuses the cached hardware and only draws the overlay.
+
+An Overlay is a list of ops at their offset in the component: text is
+its font mask filled with the label color, exactly as ImageDraw draws
+it, and a patch is an RGBA image alpha composited over the pixels below
+it (the datapack boxes).  Ops draw in order and are clipped to the
+component, so the result is the same as drawing the labels straight
+onto the hardware.
+
+    overlay = labels.Overlay((101, 513))
+    overlay.text("4.5TB", 50, 18)
+    overlay.draw(tile)
+"""
+from PIL import Image
+from PIL import ImageDraw
+from . import cache
+from . import utils
+
+label_color = (199, 89, 40)
+
+# (text, font size): (mask, offset), drawn once per process
+masks = {}
+
+
+def text_mask(text, font_size):
+    """ The L mask ImageDraw fills for text drawn at (0, 0) and its
+        offset from there, None if nothing is drawn.
+    """
+    key = (text, font_size)
+    if key not in masks:
+        font = utils.get_font(font_size)
+        left, top, right, bottom = font.getbbox(text)
+        if right <= left or bottom <= top:
+            masks[key] = None
+        else:
+            pad = (max(0, -left), max(0, -top))
+            mask = Image.new("L", (right + pad[0], bottom + pad[1]), 0)
+            ImageDraw.Draw(mask).text(pad, text, fill=255, font=font)
+            masks[key] = (mask, (-pad[0], -pad[1]))
+    return masks[key]
+
+
+class Overlay():
+    """ Labels for a component of size, see the module doc. """
+
+    def __init__(self, size):
+        self.size = size
+        self.ops = []
+        self.bytes = 0
+        self.patches = 0
+
+    def add(self, kind, loc, img):
+        # clipped to the component like drawing on it would be
+        box = (max(0, -loc[0]), max(0, -loc[1]),
+               min(img.size[0], self.size[0] - loc[0]),
+               min(img.size[1], self.size[1] - loc[1]))
+        if box[2] <= box[0] or box[3] <= box[1]:
+            return
+        if box != (0, 0) + img.size:
+            img = img.crop(box)
+        self.ops.append((kind, (loc[0] + box[0], loc[1] + box[1]), img))
+        self.bytes += cache.image_bytes(img)
+        if kind == "patch":
+            self.patches += 1
+
+    def text(self, text, x_loc, y_loc, font_size=15):
+        """ text centered on x_loc, placed like utils.apply_text. """
+        found = text_mask(text, font_size)
+        if found is None:
+            return
+        mask, offset = found
+        w, _ = utils.get_font(font_size).getsize(text)
+        self.add("text", (x_loc - w // 2 + offset[0], y_loc + offset[1]),
+                 mask)
+
+    def patch(self, img, loc):
+        self.add("patch", loc, img)
+
+    def extend(self, overlay, loc):
+        """ Add overlay's ops, overlay's component is at loc in this one. """
+        for kind, op_loc, img in overlay.ops:
+            self.add(kind, (op_loc[0] + loc[0], op_loc[1] + loc[1]), img)
+
+    def rotated(self):
+        """ The overlay for the component turned by rotate(-90,
+            expand=True), a quarter turn clockwise.
+        """
+        overlay = Overlay((self.size[1], self.size[0]))
+        for kind, (x, y), img in self.ops:
+            overlay.add(kind, (self.size[1] - y - img.size[1], x),
+                        img.rotate(-90, expand=True))
+        return overlay
+
+    def draw(self, img):
+        for kind, loc, op_img in self.ops:
+            box = loc + (loc[0] + op_img.size[0], loc[1] + op_img.size[1])
+            if kind == "text":
+                img.paste(label_color, box, op_img)
+            else:
+                below = img.crop(box).convert("RGBA")
+                img.paste(Image.alpha_composite(below, op_img), loc)
+        return img
+
+
+def get_overlay(key, builder, cached=True):
+    """ The overlay builder() makes, shared through the label cache. """
+    overlay = cache.label_cache.get(key) if cached else None
+    if overlay is None:
+        overlay = builder()
+        cache.label_cache.put(key, overlay)
+    return overlay
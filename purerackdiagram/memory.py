@@ -0,0 +1,134 @@
+"""
+Image memory estimates and admission control.
+
+get_diagram() works out the bytes of image memory a diagram will need,
+the output canvas every component is drawn into, from the parsed config
+and the asset dimensions (read from the png headers, nothing is
+decoded).  A diagram over the per request budget is rejected right
+there, before its components are listed, laid out or classified.
+Before the render reserve() then:
+
+    rejects a request estimated over the per request budget,
+        PURERACK_REQUEST_MEMORY_MB (default 1024)
+    queues a request that would push all the renders in flight over the
+        process budget, PURERACK_MEMORY_MB (default 2048), until enough
+        is released, rejecting it after PURERACK_MEMORY_WAIT_S seconds
+        (default 30)
+
+Each render measures its own peak: the growth of the process' resident
+set from admission, sampled once the components are composed and again
+after the encode, when everything the render holds is alive.  Renders
+running alongside it in the process are in that growth too.  stats
+keeps the largest estimate and peak next to the process' max rss, for
+tuning the budgets against what was really used.
+"""
+import logging
+import os
+import resource
+import threading
+from PIL import Image
+from . import utils
+
+logger = logging.getLogger()
+
+request_budget = int(os.environ.get("PURERACK_REQUEST_MEMORY_MB",
+                                    1024)) * 1024 * 1024
+process_budget = int(os.environ.get("PURERACK_MEMORY_MB",
+                                    2048)) * 1024 * 1024
+wait_timeout = float(os.environ.get("PURERACK_MEMORY_WAIT_S", 30))
+
+reserved = 0
+condition = threading.Condition()
+stats = {"admitted": 0, "queued": 0, "rejected": 0,
+         "max_estimate": 0, "max_peak": 0, "max_rss": 0}
+
+asset_infos = {}
+
+page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def image_bytes(size):
+    # pillow stores RGB and RGBA images as 4 bytes a pixel
+    return size[0] * size[1] * 4
+
+
+def asset_info(key):
+    """ ((width, height), mode) of an asset from its png header. """
+    if key not in asset_infos:
+        with Image.open(os.path.join(utils.root_path, key)) as img:
+            mode = "RGBA" if img.mode == "RGBA" else "RGB"
+            asset_infos[key] = (img.size, mode)
+    return asset_infos[key]
+
+
+def to_mb(num_bytes):
+    return num_bytes / (1024.0 * 1024.0)
+
+
+def check_request(num_bytes):
+    """ Raise if a render estimated at num_bytes is over the per request
+        budget, it could never be admitted.
+    """
+    if num_bytes > request_budget:
+        stats["rejected"] += 1
+        raise Exception(
+            "Diagram needs about {:.0f} MB to render, over the {:.0f} MB "
+            "limit, use fewer chassis or shelves".format(
+                to_mb(num_bytes), to_mb(request_budget)))
+
+
+def reserve(num_bytes):
+    """ Admit a render estimated at num_bytes, waits while the process
+        is over budget.  Raises if it can never or did not fit.
+    """
+    global reserved
+
+    check_request(num_bytes)
+    with condition:
+        # a request bigger than the process budget still runs, alone
+        def fits():
+            return reserved == 0 or reserved + num_bytes <= process_budget
+
+        if not fits():
+            stats["queued"] += 1
+            if not condition.wait_for(fits, timeout=wait_timeout):
+                stats["rejected"] += 1
+                raise Exception(
+                    "Server busy, {:.0f} MB of renders in flight, try "
+                    "again".format(to_mb(reserved)))
+        reserved += num_bytes
+        stats["admitted"] += 1
+
+
+def release(num_bytes):
+    global reserved
+
+    with condition:
+        reserved -= num_bytes
+        condition.notify_all()
+
+
+def record(estimate, peak):
+    """ Keep track of how the estimates compare to what was used. """
+    stats["max_estimate"] = max(stats["max_estimate"], estimate)
+    stats["max_peak"] = max(stats["max_peak"], peak or 0)
+    stats["max_rss"] = max_rss()
+    logger.debug("Render memory estimate {:.1f} MB, peak {:.1f} MB, "
+                 "process max rss {:.0f} MB".format(
+                     to_mb(estimate), to_mb(peak or 0),
+                     to_mb(stats["max_rss"])))
+
+
+def current_rss():
+    """ Bytes resident now, None where /proc isn't available. """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * page_size
+    except (IOError, ValueError, IndexError):
+        return None
+
+
+def max_rss():
+    """ Bytes of the process' resident set high-water mark. """
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
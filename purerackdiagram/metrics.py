@@ -0,0 +1,368 @@
+"""
+In-process metrics in the Prometheus text format.
+
+Counters and histograms are recorded on the render path.  Each thread
+records into its own shard, so recording takes no lock, the shards are
+only summed when the metrics are exposed.  Cache, memory, scheduler and
+persistence stats that are already kept elsewhere are read at exposition
+time.
+
+    metrics.requests.inc("fa", "front")
+    metrics.render_seconds.observe(0.25, "fa")
+    print(metrics.expose())
+
+server.py serves expose() on /metrics.  In a pre-fork server every
+worker has its own registry, a scrape sees the worker that answered it,
+purerack_process_info has its pid.
+"""
+import os
+import threading
+import time
+from . import cache
+
+registry = []
+
+# shards kept before the ones of exited threads are folded without a
+# scrape, doubled past the live threads so folding stays cheap
+fold_shards = 64
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ['{}="{}"'.format(name, str(value).replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric():
+    """ Base for the recorded metrics, keeps a shard of values per
+        thread.  Shards of threads that have exited are folded into
+        retired on every scrape, and when a new shard would pass
+        fold_at, so per request threads don't pile up in a worker that
+        is never scraped.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = {}
+        self.fold_at = fold_shards
+        registry.append(self)
+
+    def shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = {}
+            with self.lock:
+                if len(self.shards) >= self.fold_at:
+                    self.fold()
+                    self.fold_at = max(fold_shards, 2 * len(self.shards))
+                self.shards.append((threading.current_thread(), values))
+            self.local.values = values
+            return values
+
+    def fold(self):
+        # with the lock held, a thread that exited can't record anymore,
+        # its shard is safe to fold
+        live = []
+        for thread, values in self.shards:
+            if thread.is_alive():
+                live.append((thread, values))
+            else:
+                self.merge(self.retired, values)
+        self.shards = live
+
+    def merge(self, total, values):
+        raise NotImplementedError()
+
+    def collect(self):
+        """ {label values: value} summed over every thread. """
+        with self.lock:
+            self.fold()
+            total = {}
+            self.merge(total, self.retired)
+            for _, values in self.shards:
+                # copied first, the thread may be adding a label set
+                self.merge(total, dict(values))
+        return total
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        values = self.shard()
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def merge(self, total, values):
+        for key, value in values.items():
+            total[key] = total.get(key, 0) + value
+
+    def expose(self):
+        lines = []
+        for key, value in sorted(self.collect().items()):
+            lines.append("{}{} {}".format(
+                self.name, format_labels(self.labels, key),
+                format_value(value)))
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets, labels=()):
+        Metric.__init__(self, name, help_text, labels)
+        self.buckets = list(buckets)
+
+    def observe(self, value, *label_values):
+        values = self.shard()
+        counts = values.get(label_values)
+        if counts is None:
+            # a count per bucket, then +Inf, then the sum
+            counts = values[label_values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-2] += 1
+        counts[-1] += value
+
+    def merge(self, total, values):
+        for key, counts in values.items():
+            counts = list(counts)
+            if key in total:
+                total[key] = [a + b for a, b in zip(total[key], counts)]
+            else:
+                total[key] = counts
+
+    def expose(self):
+        lines = []
+        for key, counts in sorted(self.collect().items()):
+            cumulative = 0
+            bounds = [format_value(b) for b in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts[:-1]):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(self.labels + ("le",), key + (bound,)),
+                    cumulative))
+            labels = format_labels(self.labels, key)
+            lines.append("{}_sum{} {}".format(self.name, labels,
+                                              format_value(counts[-1])))
+            lines.append("{}_count{} {}".format(self.name, labels,
+                                                cumulative))
+        return lines
+
+    def time(self, *label_values):
+        return Timer(self, label_values)
+
+
+class Timer():
+    """ with histogram.time("fa"): observes the seconds the block took. """
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start,
+                               *self.label_values)
+
+
+class Collected():
+    """ Values read from stats kept elsewhere when the metrics are
+        exposed, func returns {label values: value}.
+    """
+
+    def __init__(self, name, help_text, kind, func, labels=()):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.func = func
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def expose(self):
+        return ["{}{} {}".format(self.name, format_labels(self.labels, key),
+                                 format_value(value))
+                for key, value in sorted(self.func().items())]
+
+
+def expose():
+    """ Every metric in the Prometheus text exposition format. """
+    lines = []
+    for metric in registry:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def model_family(model):
+    model = str(model or "").lower()
+    for family in ["fa", "fb", "rack"]:
+        if model.startswith(family):
+            return family
+    return "other"
+
+
+latency_buckets = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0]
+size_buckets = [2 ** i * 1024 for i in range(4, 15, 2)]
+
+requests = Counter("purerack_requests_total",
+                   "Diagram requests by model family and face",
+                   ["family", "face"])
+errors = Counter("purerack_errors_total",
+                 "Failed requests by exception type and the stage it "
+                 "failed in", ["type", "stage"])
+render_seconds = Histogram("purerack_render_seconds",
+                           "Time to render a diagram image",
+                           latency_buckets, ["family"])
+encode_seconds = Histogram("purerack_encode_seconds",
+                           "Time to encode a rendered image to PNG",
+                           latency_buckets, ["family"])
+asset_load_seconds = Histogram("purerack_asset_load_seconds",
+                               "Time to decode or map an asset",
+                               latency_buckets)
+cancelled = Counter("purerack_cancelled_total",
+                    "Requests cancelled by reason and the stage they "
+                    "stopped at", ["reason", "stage"])
+cancel_skipped = Counter("purerack_cancel_skipped_total",
+                         "Render work skipped for cancelled requests, "
+                         "queued renders, component builds, compositions "
+                         "and encodes", ["stage"])
+output_bytes = Histogram("purerack_output_bytes",
+                         "Response payload size by output format, before "
+                         "base64",
+                         size_buckets, ["format"])
+
+
+def asset_stats():
+    from . import utils
+    return {("hit",): utils.cache_stats["hits"],
+            ("miss",): utils.cache_stats["misses"]}
+
+
+def asset_bytes():
+    from . import utils
+    total = 0
+    for rack_image in list(utils.cache.values()):
+        img = rack_image.img
+        if img is not None:
+            total += img.size[0] * img.size[1] * len(img.getbands())
+    return {(): total}
+
+
+caches = [("component", cache.component_cache),
+          ("label", cache.label_cache),
+          ("render", cache.render_cache)]
+
+
+def cache_stats(stat):
+    def func():
+        return {(name,): lru.stats[stat] for name, lru in caches}
+    return func
+
+
+def cache_sizes(attr):
+    def func():
+        return {(name,): len(lru.items) if attr == "items" else lru.bytes
+                for name, lru in caches}
+    return func
+
+
+def memory_reserved():
+    from . import memory
+    return {(): memory.reserved}
+
+
+def scheduler_state(state):
+    def func():
+        from . import scheduler
+        values = scheduler.running if state == "running" else \
+            {lane: len(tickets) for lane, tickets in
+             scheduler.waiting.items()}
+        return {(lane,): count for lane, count in values.items()}
+    return func
+
+
+def persist_depth():
+    from . import persist
+    writer = persist.writer
+    return {(): writer.depth() if writer is not None else 0}
+
+
+def persist_stats(names):
+    def func():
+        from . import persist
+        return {(name,): persist.stats[name] for name in names}
+    return func
+
+
+def route_stats():
+    from . import routing
+    return {(name,): count for name, count in routing.stats.items()}
+
+
+Collected("purerack_asset_requests_total",
+          "Asset cache lookups by result", "counter", asset_stats,
+          ["result"])
+Collected("purerack_asset_resident_bytes",
+          "Decoded asset bytes held by the asset cache", "gauge",
+          asset_bytes)
+Collected("purerack_cache_hits_total", "LRU cache hits", "counter",
+          cache_stats("hits"), ["cache"])
+Collected("purerack_cache_misses_total", "LRU cache misses", "counter",
+          cache_stats("misses"), ["cache"])
+Collected("purerack_cache_evictions_total", "LRU cache evictions",
+          "counter", cache_stats("evictions"), ["cache"])
+Collected("purerack_cache_items", "Entries in the LRU cache", "gauge",
+          cache_sizes("items"), ["cache"])
+Collected("purerack_cache_bytes", "Bytes held by the LRU cache", "gauge",
+          cache_sizes("bytes"), ["cache"])
+Collected("purerack_memory_reserved_bytes",
+          "Image memory reserved by renders in flight", "gauge",
+          memory_reserved)
+Collected("purerack_scheduler_running", "Renders running by lane",
+          "gauge", scheduler_state("running"), ["lane"])
+Collected("purerack_scheduler_waiting", "Renders waiting by lane",
+          "gauge", scheduler_state("waiting"), ["lane"])
+Collected("purerack_persist_queue_depth",
+          "Writes waiting in the write-behind queue", "gauge",
+          persist_depth)
+Collected("purerack_persist_writes_total",
+          "Write-behind writes by outcome", "counter",
+          persist_stats(["queued", "coalesced", "dropped", "written",
+                         "failed"]), ["outcome"])
+Collected("purerack_persist_lookups_total",
+          "Persisted render lookups by result", "counter",
+          persist_stats(["hits", "misses"]), ["result"])
+Collected("purerack_route_requests_total",
+          "Requests routed to the worker owning the key or, over the "
+          "load bound, to the next one", "counter", route_stats,
+          ["result"])
+Collected("purerack_process_info", "Process the metrics come from",
+          "gauge", lambda: {(os.getpid(),): 1}, ["pid"])
+
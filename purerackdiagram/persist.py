@@ -0,0 +1,246 @@
+"""
+Write-behind persistence of rendered results.
+
+Set PURERACK_PERSIST to a directory to keep finished PNGs across
+processes and containers.  render_png() looks there after a render
+cache miss, and a new render is handed to a bounded queue that a
+background thread writes out, so the client never waits on the disk.
+Set PURERACK_PERSIST_COMPONENTS=1 to persist built component tiles
+too.  They're written for other tools to use and never read back,
+decoding a tile costs about as much as building it.
+
+The queue is bounded by PURERACK_PERSIST_QUEUE writes (default 64) and
+PURERACK_PERSIST_QUEUE_MB (default 64).  A write for a key that's
+already queued replaces it (coalesced), a write that doesn't fit is
+dropped, it's only a cache.  flush() waits for the queue to drain,
+stop() flushes and stops the writer, the lambda and server.py call it
+on shutdown.
+
+Objects are stored under the asset version (see bundle.asset_version),
+so results from other assets or render code are never served.
+
+    persist.configure("/var/cache/purerack")
+    ...
+    persist.stop(timeout=5)
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image
+
+logger = logging.getLogger()
+
+max_writes = int(os.environ.get("PURERACK_PERSIST_QUEUE", 64))
+max_bytes = int(os.environ.get("PURERACK_PERSIST_QUEUE_MB", 64)) * 1024 * 1024
+persist_components = os.environ.get("PURERACK_PERSIST_COMPONENTS", "") \
+    not in ("", "0")
+
+stats = {"queued": 0, "coalesced": 0, "dropped": 0, "written": 0,
+         "failed": 0, "hits": 0, "misses": 0}
+
+
+class DirectoryStore():
+    """ Objects as files under a directory, fanned out by the first
+        byte of the key hash like an object store.  An object store
+        backend only needs get() and put().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.version = None
+
+    def object_path(self, key):
+        if self.version is None:
+            # bundle imports the renderers, which import this module
+            from . import bundle
+            self.version = bundle.asset_version()[:16]
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self.path, self.version, digest[:2],
+                            digest + ".png")
+
+    def get(self, key):
+        try:
+            with open(self.object_path(key), "rb") as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, key, data):
+        path = self.object_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, a reader never sees half an object
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+class WriteBehind():
+    """ Bounded queue of pending writes and the thread that writes them.
+        Values are PNG bytes or a component image, encoded on the writer
+        thread.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.pending = OrderedDict()
+        self.bytes = 0
+        self.writing = 0
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="purerack-persist")
+        self.thread.start()
+
+    def submit(self, key, value, size):
+        """ Queue a write without blocking, False if it was dropped. """
+        with self.condition:
+            if not self.running:
+                return False
+            if key in self.pending:
+                self.bytes -= self.pending.pop(key)[1]
+                stats["coalesced"] += 1
+            elif len(self.pending) >= max_writes or \
+                    self.bytes + size > max_bytes:
+                stats["dropped"] += 1
+                return False
+
+            self.pending[key] = (value, size)
+            self.bytes += size
+            stats["queued"] += 1
+            self.condition.notify_all()
+            return True
+
+    def depth(self):
+        return len(self.pending)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                key, (value, size) = self.pending.popitem(last=False)
+                self.bytes -= size
+                self.writing += 1
+
+            try:
+                if isinstance(value, Image.Image):
+                    buffered = BytesIO()
+                    # fast compression, tiles are big and rarely read
+                    value.save(buffered, format="PNG", compress_level=1)
+                    value = buffered.getvalue()
+                self.store.put(key, value)
+                stats["written"] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                logger.warning("Failed to persist {}: {}".format(key, e))
+            finally:
+                with self.condition:
+                    self.writing -= 1
+                    self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """ Wait for every queued write, True if they all finished. """
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.pending and not self.writing, timeout)
+
+    def stop(self, timeout=None):
+        done = self.flush(timeout)
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        return done
+
+
+writer = None
+
+
+def configure(path):
+    """ Persist to a directory, None turns persistence off.  Anything
+        still queued for the previous store is flushed first.
+    """
+    global writer
+
+    if writer is not None:
+        writer.stop()
+    writer = WriteBehind(DirectoryStore(path)) if path else None
+
+
+def enabled():
+    return writer is not None
+
+
+def load_render(key):
+    """ (png_bytes, (width, height)) of a persisted render, or None. """
+    if writer is None:
+        return None
+    png = writer.store.get("render:" + key)
+    if png is None:
+        stats["misses"] += 1
+        return None
+    stats["hits"] += 1
+    with Image.open(BytesIO(png)) as img:
+        return png, img.size
+
+
+def save_render(key, result):
+    # result is (png_bytes, (width, height)), as in the render cache
+    if writer is not None:
+        writer.submit("render:" + key, result[0], len(result[0]))
+
+
+def save_component(key, img):
+    # img is shared with the component cache, it's never written to
+    if writer is not None and persist_components:
+        writer.submit("component:" + key, img,
+                      img.size[0] * img.size[1] * 4)
+
+
+def flush(timeout=None):
+    if writer is None:
+        return True
+    return writer.flush(timeout)
+
+
+def stop(timeout=None):
+    """ Flush and stop the writer, for shutdown hooks. """
+    global writer
+
+    if writer is None:
+        return True
+    start = time.time()
+    done = writer.stop(timeout)
+    logger.info("Persisted queued writes in {:.2f}s".format(
+        time.time() - start))
+    writer = None
+    return done
+
+
+def stop_thread():
+    """ Stop the writer thread but keep the store, for a pre-fork
+        server's parent, which never writes.  Its workers each start
+        their own writer after the fork.
+    """
+    if writer is not None:
+        writer.stop()
+
+
+def restart_after_fork():
+    # the writer thread doesn't survive a fork, a pre-fork server's
+    # workers each get their own
+    global writer
+
+    if writer is not None:
+        writer = WriteBehind(writer.store)
+
+
+os.register_at_fork(after_in_child=restart_after_fork)
+configure(os.environ.get("PURERACK_PERSIST"))
@@ -0,0 +1,229 @@
+"""
+Adaptive cache pre-warming.
+
+Every request records the canonical diagram key and each component key
+(chassis, shelf, FB chassis) in a small frequency sketch.  The sketch
+can be saved and loaded, and a background Prewarmer renders the hottest
+entries that aren't cached into the render and component caches.
+
+Warming is rate-limited and only starts while no live render is in
+flight or waiting for a scheduler slot.  A warm that's running when a
+live request arrives is cancelled at its next stage (see
+cancellation.py) and picked up again on a later pass, so it never
+competes with real requests.  Warmed diagrams are marked background,
+they aren't recorded in the sketch or counted as live renders.
+
+    prewarm.start("/tmp/purerack_sketch.json", interval=300)
+"""
+import json
+import logging
+import os
+import threading
+import purerackdiagram
+from . import cache
+from . import cancellation
+from . import scheduler
+from . import utils
+
+logger = logging.getLogger()
+
+
+class FrequencySketch():
+    """ Space-saving top-k counter, never holds more than capacity keys.
+        When full, a new key replaces the least counted one and inherits
+        its count.  Every decay_every records all counts are halved, so
+        configs that fall out of favour age out.
+    """
+
+    def __init__(self, capacity=512, decay_every=10000):
+        self.capacity = capacity
+        self.decay_every = decay_every
+        self.counts = {}
+        self.payloads = {}
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def record(self, key, payload):
+        with self.lock:
+            if key in self.counts:
+                self.counts[key] += 1
+            else:
+                count = 1
+                if len(self.counts) >= self.capacity:
+                    coldest = min(self.counts, key=self.counts.get)
+                    count = self.counts.pop(coldest) + 1
+                    del self.payloads[coldest]
+                self.counts[key] = count
+                self.payloads[key] = payload
+
+            self.records += 1
+            if self.records % self.decay_every == 0:
+                self.decay()
+
+    def decay(self):
+        for key in list(self.counts):
+            self.counts[key] //= 2
+            if self.counts[key] == 0:
+                del self.counts[key]
+                del self.payloads[key]
+
+    def hottest(self, n):
+        with self.lock:
+            keys = sorted(self.counts, key=self.counts.get, reverse=True)
+            return [(key, self.counts[key], self.payloads[key])
+                    for key in keys[:n]]
+
+    def save(self, path):
+        with self.lock:
+            data = {"counts": self.counts, "payloads": self.payloads}
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path) as f:
+            data = json.load(f)
+        with self.lock:
+            self.counts = data["counts"]
+            self.payloads = data["payloads"]
+
+
+sketch = FrequencySketch()
+
+
+def record_diagram(diagram, max_height=None):
+    # warming doesn't count as demand
+    params = getattr(diagram, "params", None)
+    if diagram.background or params is None:
+        return
+    key = "render:{}:{}".format(diagram.get_key(), max_height)
+    sketch.record(key, {"kind": "render",
+                        "params": params,
+                        "max_height": max_height})
+
+
+def record_component(key, diagram):
+    params = getattr(diagram, "params", None)
+    if diagram.background or params is None:
+        return
+    sketch.record(key, {"kind": "component", "params": params})
+
+
+def is_cached(key, payload):
+    if payload["kind"] == "render":
+        # same key render_png uses
+        return key[len("render:"):] in cache.render_cache
+    return key in cache.component_cache
+
+
+def live_demand():
+    """ True while a live render is running or waiting for a slot. """
+    return utils.in_flight > 0 or scheduler.live_waiting()
+
+
+class YieldToLive(cancellation.CancelToken):
+    """ Cancels a warm as soon as there's live demand.  Not a request,
+        the stages it skips aren't counted as cancelled work.
+    """
+
+    @property
+    def cancelled(self):
+        if self.reason is None and live_demand():
+            self.cancel("live demand")
+        return self.reason is not None
+
+    def check(self, stage):
+        if self.cancelled:
+            raise cancellation.Cancelled(self.reason, stage)
+
+
+def warm(key, payload):
+    kind = payload["kind"]
+    diagram = purerackdiagram.get_diagram(dict(payload["params"]))
+    diagram.background = True
+    diagram.cancel = YieldToLive()
+    if kind == "render":
+        purerackdiagram.render_png(diagram, payload["max_height"])
+    elif kind == "component":
+        for component_key, builder in diagram.get_components():
+            if component_key == key:
+                diagram.build_component(component_key, builder)
+                break
+
+
+class Prewarmer():
+    """ Background thread warming the hottest sketch entries.
+        Args:
+            path: where the sketch is loaded from and saved to, optional
+            interval: seconds between warming passes
+            top: how many of the hottest entries to keep warm
+            rate: max warms per second
+    """
+
+    def __init__(self, path=None, interval=300, top=32, rate=2.0):
+        self.path = path
+        self.interval = interval
+        self.top = top
+        self.rate = rate
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.warmed = 0
+        self.yielded = 0
+
+    def wait_until_idle(self):
+        # never start a warm while a live render is running or queued
+        while live_demand():
+            if self.stop_event.wait(0.05):
+                return False
+        return True
+
+    def warm_hottest(self):
+        for key, _, payload in sketch.hottest(self.top):
+            if self.stop_event.is_set():
+                return
+            if is_cached(key, payload):
+                continue
+            if not self.wait_until_idle():
+                return
+
+            try:
+                warm(key, payload)
+                self.warmed += 1
+            except cancellation.Cancelled:
+                # a live request came in, it's warmed on a later pass
+                self.yielded += 1
+            except Exception as e:
+                logger.warning("Pre-warm failed for {}: {}".format(key, e))
+
+            # rate limit between warms
+            if self.stop_event.wait(1.0 / self.rate):
+                return
+
+    def run(self):
+        if self.path and os.path.exists(self.path):
+            sketch.load(self.path)
+
+        while not self.stop_event.is_set():
+            self.warm_hottest()
+            if self.path:
+                sketch.save(self.path)
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name="purerack-prewarm")
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def start(path=None, interval=300, top=32, rate=2.0):
+    """ Load the sketch from path if it exists, warm now and then every
+        interval seconds, saving the sketch each pass.
+    """
+    return Prewarmer(path, interval, top, rate).start()
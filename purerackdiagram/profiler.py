@@ -0,0 +1,149 @@
+"""
+On-demand profiles of single requests.
+
+Set PURERACK_PROFILE_TOKEN to allow it, a request with profile=<token>
+then runs under cProfile from parsing to the encoded image, any other
+profile value gets a 403.  The profiled diagram skips the bundle, the
+render cache, the persisted renders and the component and label caches
+and builds its components on the request's thread, so the profile has
+the whole render: parsing, datapack labels, text rendering, composition
+and encode.  Asset loads are in it when the asset wasn't loaded in the
+process yet.
+Requests without the flag never touch the profiler.
+
+Each profile is written to PURERACK_PROFILE_DIR (default
+purerack-profiles in the temp dir) as a .prof for pstats or snakeviz
+and a .txt report, the time spent in each stage and the top
+functions by cumulative time.  The response has the file name in
+X-Profile, with profile_output=text the report is the body instead of
+the image.  cProfile slows pure python down, compare stages with each
+other rather than with unprofiled timings.
+
+    png, size, report = profiler.profile_render(params)
+    print(report.text)
+"""
+import cProfile
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger()
+
+token = os.environ.get("PURERACK_PROFILE_TOKEN", "")
+profile_dir = os.environ.get(
+    "PURERACK_PROFILE_DIR",
+    os.path.join(tempfile.gettempdir(), "purerack-profiles"))
+top_functions = 40
+
+# the stages in the report, the cumulative time of (file, function)
+stages = [("parse", "__init__.py", "get_diagram"),
+          ("asset load", "utils.py", "load_img"),
+          ("dp label", "flasharray.py", "dp_label_patch"),
+          ("text", "ImageDraw.py", "text"),
+          ("labels", "labels.py", "draw"),
+          ("composition", "utils.py", "render"),
+          ("encode", "Image.py", "save")]
+
+# newer pythons allow one profiler per process, profiles take turns
+lock = threading.Lock()
+
+
+def authorized(value):
+    """ True if value is the profile token and profiling is enabled. """
+    if token and hmac.compare_digest(str(value), token):
+        return True
+    logger.warning("Profile request denied")
+    return False
+
+
+def report_name(params):
+    digest = hashlib.sha256(
+        json.dumps(params, sort_keys=True).encode()).hexdigest()
+    now = time.time()
+    return "{}.{:03d}-{}-{}".format(
+        time.strftime("%Y%m%d-%H%M%S", time.localtime(now)),
+        int(now * 1000) % 1000, params.get("model", "fa"), digest[:12])
+
+
+def stage_seconds(stats):
+    seconds = {}
+    for stage, file_name, function in stages:
+        seconds[stage] = sum(
+            cumulative for (path, _, name), (_, _, _, cumulative, _)
+            in stats.stats.items()
+            if name == function and os.path.basename(path) == file_name)
+    return seconds
+
+
+class Report():
+    """ A finished profile, written as name.prof and name.txt. """
+
+    def __init__(self, profile, seconds, name, out_dir=None):
+        out_dir = out_dir or profile_dir
+        self.seconds = seconds
+        self.stats = pstats.Stats(profile)
+        self.stages = stage_seconds(self.stats)
+        self.text = self.format(name)
+
+        os.makedirs(out_dir, exist_ok=True)
+        self.path = os.path.join(out_dir, name + ".prof")
+        self.stats.dump_stats(self.path)
+        with open(os.path.join(out_dir, name + ".txt"), "w") as f:
+            f.write(self.text)
+        logger.info("Profile written to {}".format(self.path))
+
+    def format(self, name):
+        lines = ["profile {}".format(name),
+                 "total {:.1f} ms".format(self.seconds * 1000), ""]
+        for stage, seconds in self.stages.items():
+            lines.append("{:<12} {:8.1f} ms".format(stage, seconds * 1000))
+        lines.append("")
+
+        top = io.StringIO()
+        self.stats.stream = top
+        self.stats.sort_stats("cumulative").print_stats(top_functions)
+        self.stats.stream = None
+        return "\n".join(lines) + top.getvalue()
+
+
+class Capture():
+    """ with Capture() as capture: profiles the block on this thread,
+        capture.save(name) writes the report.
+    """
+
+    def __enter__(self):
+        lock.acquire()
+        self.profile = cProfile.Profile()
+        self.start = time.perf_counter()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.disable()
+        self.seconds = time.perf_counter() - self.start
+        lock.release()
+
+    def save(self, name, out_dir=None):
+        return Report(self.profile, self.seconds, name, out_dir)
+
+
+def profile_render(params, max_height=None, output_format="png",
+                   out_dir=None):
+    """ Render params under the profiler, like render_png() without any
+        caches.  Returns (png_bytes, (width, height), Report).
+    """
+    import purerackdiagram
+
+    with Capture() as capture:
+        diagram = purerackdiagram.get_diagram(dict(params))
+        diagram.profiling = True
+        png, size = purerackdiagram.render_png(diagram, max_height,
+                                               output_format)
+    return png, size, capture.save(report_name(params), out_dir)
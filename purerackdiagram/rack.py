@@ -0,0 +1,151 @@
+import json
+from PIL import Image
+from PIL import ImageDraw
+import purerackdiagram
+from .utils import Diagram, stack_layout
+
+# all of the device images are drawn at roughly 260 pixels per RU
+ru_height = 260
+ru_width = 2859
+default_rack_size = 42
+
+# only ever need one blank spacer, it's the same for every empty RU
+blank_ru_img = None
+
+
+def get_blank_ru():
+    global blank_ru_img
+
+    if blank_ru_img is None:
+        img = Image.new("RGB", (ru_width, ru_height), (24, 24, 24))
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((0, 0, ru_width - 1, ru_height - 1),
+                       outline=(64, 64, 64), width=4)
+        blank_ru_img = img
+    return blank_ru_img
+
+
+def draw_blank_ru(target=None):
+    return get_blank_ru()
+
+
+class RackDiagram(Diagram):
+    """ A full rack elevation, made up of several FlashArray and
+        FlashBlade devices each placed at an RU position.
+
+        params:
+            rack_size: number of RU in the rack, default 42
+            face: front or back, used for any device that doesn't set it
+            devices: list (or json string of a list) of device params,
+                     each one the same params as a single diagram plus
+                     "position", the lowest RU the device sits in
+                     (RU 1 is the bottom of the rack).
+    """
+
+    family = "rack"
+
+    def __init__(self, params):
+        config = {}
+        config["rack_size"] = int(params.get("rack_size", default_rack_size))
+        config["ru"] = config["rack_size"]
+        config["face"] = params.get("face", "front").lower()
+
+        devices = params.get("devices", [])
+        if isinstance(devices, str):
+            devices = json.loads(devices)
+
+        self.diagrams = []
+        config["devices"] = []
+        used_ru = {}
+        for device_params in devices:
+            device_params = dict(device_params)
+            if "position" not in device_params:
+                raise Exception("Each rack device needs a position, the "
+                                "lowest RU the device is mounted in")
+            position = int(device_params.pop("position"))
+            device_params.setdefault("face", config["face"])
+
+            # parse the device now so bad configs fail before rendering
+            diagram = purerackdiagram.get_diagram(device_params)
+            device_ru = diagram.config["ru"]
+            top = position + device_ru - 1
+
+            if position < 1 or top > config["rack_size"]:
+                raise Exception(
+                    "Device {} at RU {} with height {}RU does not fit in a "
+                    "{}RU rack".format(device_params["model"], position,
+                                       device_ru, config["rack_size"]))
+
+            for ru in range(position, top + 1):
+                if ru in used_ru:
+                    raise Exception(
+                        "Device {} at RU {} overlaps {} at RU {}".format(
+                            device_params["model"], position,
+                            used_ru[ru][0], used_ru[ru][1]))
+                used_ru[ru] = (device_params["model"], position)
+
+            self.diagrams.append(diagram)
+            config["devices"].append({"position": position,
+                                      "top": top,
+                                      "ru": device_ru,
+                                      "model": device_params["model"],
+                                      "config": diagram.config})
+
+        self.config = config
+
+    def get_components(self):
+        # every component of every device goes into one flat list, so
+        # all devices render concurrently and share the image caches.
+        # Identical components across devices are also only built once.
+        components = []
+        for diagram in self.diagrams:
+            components.extend(diagram.get_components())
+        return components
+
+    def get_component_assets(self):
+        assets = []
+        for diagram in self.diagrams:
+            assets.extend(diagram.get_component_assets())
+        return assets
+
+    def get_component_labels(self):
+        overlays = []
+        for diagram in self.diagrams:
+            overlays.extend(diagram.get_component_labels())
+        return overlays
+
+    def estimate_size(self):
+        sizes = [diagram.estimate_size() for diagram in self.diagrams]
+        blank_ru = self.config["rack_size"] - sum(
+            device["ru"] for device in self.config["devices"])
+        return (max([ru_width] + [w for w, _ in sizes]),
+                sum(h for _, h in sizes) + blank_ru * ru_height)
+
+    def get_full_layout(self):
+        # every device is laid out on its own and placed at its RU, so
+        # all the components of all the devices draw straight into the
+        # rack canvas.  Device components are named device1.chassis,
+        # device2.shelf1 and so on, in the order of the devices param.
+        by_top = {}
+        for number, (diagram, device) in enumerate(
+                zip(self.diagrams, self.config["devices"]), 1):
+            size, slots, places = diagram.get_full_layout()
+            places = [("device{}.{}".format(number, name), high - low + 1)
+                      for name, low, high in places]
+            by_top[device["top"]] = (device, (size, slots, places))
+
+        # walk the rack from the top RU down, empty RUs get a spacer
+        blank = [("blank_ru", draw_blank_ru, (0, 0),
+                  (ru_width, ru_height), "RGB", None)]
+        parts = []
+        ru = self.config["rack_size"]
+        while ru >= 1:
+            if ru in by_top:
+                device, layout = by_top[ru]
+                parts.append(layout)
+                ru = device["position"] - 1
+            else:
+                parts.append(((ru_width, ru_height), blank, [("blank", 1)]))
+                ru -= 1
+
+        return stack_layout(parts)
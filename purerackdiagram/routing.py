@@ -0,0 +1,117 @@
+"""
+Consistent-hash routing of requests to render workers.
+
+Every worker warms its own component and render caches, so sending the
+same diagram to the same worker keeps hit rates up as workers are
+added.  route_key() is the diagram's canonical key, params that parse
+to the same config go to the same worker.  HashRing places every worker
+at many points (virtual nodes) on a ring of 64 bit hashes, a key goes
+to the first worker clockwise from its hash, so adding or removing a
+worker only moves about 1/n of the keys.
+
+Hot keys are kept from swamping one worker with bounded loads: a worker
+is skipped while it has more than load_factor times the average
+requests in flight and the key goes to the next worker on the ring.
+PURERACK_ROUTE_VNODES (default 128) sets the points per worker and
+PURERACK_ROUTE_LOAD_FACTOR (default 1.25) the bound.
+
+    ring = HashRing(["w0", "w1", "w2"])
+    worker = ring.acquire(routing.route_key(params))
+    try:
+        ...
+    finally:
+        ring.release(worker)
+"""
+import bisect
+import hashlib
+import math
+import os
+import threading
+import purerackdiagram
+
+vnodes = int(os.environ.get("PURERACK_ROUTE_VNODES", 128))
+load_factor = float(os.environ.get("PURERACK_ROUTE_LOAD_FACTOR", 1.25))
+
+stats = {"owner": 0, "overflow": 0}
+
+
+def hash64(value):
+    # stable across processes, unlike hash()
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+def route_key(params):
+    """ Canonical key of the diagram params describe.  Params that don't
+        parse are routed by their own text, they fail quickly anywhere.
+    """
+    try:
+        return purerackdiagram.get_diagram(dict(params)).get_key()
+    except Exception:
+        return "&".join("{}={}".format(k, v)
+                        for k, v in sorted(params.items()))
+
+
+class HashRing():
+    def __init__(self, nodes, vnodes=vnodes, load_factor=load_factor):
+        self.vnodes = vnodes
+        self.load_factor = load_factor
+        self.lock = threading.Lock()
+        self.load = {}
+        self.points = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        with self.lock:
+            self.load.setdefault(node, 0)
+            for i in range(self.vnodes):
+                self.points.append((hash64("{}#{}".format(node, i)), node))
+            self.points.sort()
+            self.hashes = [h for h, _ in self.points]
+
+    def remove(self, node):
+        with self.lock:
+            self.load.pop(node, None)
+            self.points = [p for p in self.points if p[1] != node]
+            self.hashes = [h for h, _ in self.points]
+
+    def walk(self, key):
+        """ Every node in ring order starting at key's position. """
+        start = bisect.bisect(self.hashes, hash64(key))
+        seen = set()
+        for i in range(len(self.points)):
+            node = self.points[(start + i) % len(self.points)][1]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.load):
+                    return
+
+    def lookup(self, key):
+        """ The node that owns key, ignoring load. """
+        with self.lock:
+            return next(self.walk(key), None)
+
+    def acquire(self, key):
+        """ Node to send key to, counted as in flight until release(). """
+        with self.lock:
+            if not self.load:
+                raise Exception("No render workers to route to")
+            # the cap counts this request, so an idle ring always has room
+            in_flight = sum(self.load.values()) + 1
+            cap = math.ceil(self.load_factor * in_flight / len(self.load))
+
+            owner = None
+            for node in self.walk(key):
+                if owner is None:
+                    owner = node
+                if self.load[node] < cap:
+                    break
+            stats["owner" if node == owner else "overflow"] += 1
+            self.load[node] += 1
+            return node
+
+    def release(self, node):
+        with self.lock:
+            if node in self.load:
+                self.load[node] -= 1
@@ -0,0 +1,179 @@
+"""
+Priority lanes for renders.
+
+Every render is classified by its estimated cost from the parsed config,
+before anything is loaded:
+
+    cost = components + ru / 4, doubled for a vssx stencil
+
+Renders costing up to PURERACK_SCHED_CHEAP (default 6, a FlashArray with
+up to a couple of shelves or a small FlashBlade) go in the interactive
+lane, the rest in the bulk lane.  At most PURERACK_SCHED_SLOTS renders
+(default cpu count, at least 2) run at once and bulk renders only ever
+get PURERACK_SCHED_BULK of them (default half), so there's always room
+for a preview.  A waiting interactive render goes before any waiting
+bulk render, except that a bulk render waiting longer than
+PURERACK_SCHED_MAX_WAIT_S seconds (default 10) gets the next free slot
+so bulk work is never starved.
+
+    with scheduler.slot(diagram, "vssx"):
+        img = diagram.render()
+
+render_png() and render_png_fit() go through a slot, cache and bundle
+hits don't wait for one.  A render whose diagram.cancel token is
+cancelled while it waits leaves the queue, see cancellation.py.
+live_waiting() tells the pre-warmer a live request is queued, a
+background render doesn't count.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+cheap_cost = float(os.environ.get("PURERACK_SCHED_CHEAP", 6))
+max_wait = float(os.environ.get("PURERACK_SCHED_MAX_WAIT_S", 10))
+# how often a waiting render checks whether it was cancelled
+cancel_poll_s = 0.1
+vssx_factor = 2.0
+
+lanes = ["interactive", "bulk"]
+limits = {}
+running = {"interactive": 0, "bulk": 0}
+waiting = {"interactive": collections.deque(), "bulk": collections.deque()}
+condition = threading.Condition()
+stats = {lane: {"admitted": 0, "waited": 0, "promoted": 0,
+                "max_wait_s": 0.0} for lane in lanes}
+
+
+def set_limits(slots, bulk_slots=None):
+    """ Renders allowed at once, in total and in the bulk lane. """
+    slots = int(slots)
+    if bulk_slots is None:
+        bulk_slots = max(1, slots // 2)
+    bulk_slots = int(bulk_slots)
+    if slots < 1 or bulk_slots < 1:
+        raise Exception("scheduler slots must be at least 1")
+
+    with condition:
+        limits["total"] = slots
+        limits["bulk"] = min(bulk_slots, slots)
+        condition.notify_all()
+
+
+set_limits(os.environ.get("PURERACK_SCHED_SLOTS",
+                          max(2, os.cpu_count() or 1)),
+           os.environ.get("PURERACK_SCHED_BULK"))
+
+
+def estimate_cost(diagram, output_format="png"):
+    """ Relative cost of rendering diagram, each component build is
+        about one and the canvas grows with the RU count.
+    """
+    if diagram.region is None:
+        components = len(diagram.get_components())
+    else:
+        # only the region's components are built
+        components = len(diagram.get_layout()[1])
+    cost = components + diagram.get_ru() / 4.0
+    if output_format == "vssx":
+        # the png is encoded again into the stencil zip and base64
+        cost *= vssx_factor
+    return cost
+
+
+def classify(diagram, output_format="png"):
+    if estimate_cost(diagram, output_format) <= cheap_cost:
+        return "interactive"
+    return "bulk"
+
+
+class Ticket():
+    def __init__(self, lane, background=False):
+        self.lane = lane
+        self.background = background
+        self.since = time.time()
+
+
+def can_start(lane):
+    if sum(running.values()) >= limits["total"]:
+        return False
+    return lane == "interactive" or running["bulk"] < limits["bulk"]
+
+
+def next_ticket():
+    """ The waiting ticket that runs next, None if none can yet. """
+    bulk = waiting["bulk"][0] if waiting["bulk"] else None
+    if bulk is not None and time.time() - bulk.since >= max_wait and \
+            running["bulk"] < limits["bulk"]:
+        # starved, it gets the next slot ahead of interactive renders
+        return bulk if can_start("bulk") else None
+
+    if waiting["interactive"] and can_start("interactive"):
+        return waiting["interactive"][0]
+    if bulk is not None and can_start("bulk"):
+        return bulk
+    return None
+
+
+def live_waiting():
+    """ True while a render other than a background one waits. """
+    with condition:
+        return any(not ticket.background
+                   for queue in waiting.values() for ticket in queue)
+
+
+def acquire(lane, cancel=None, background=False):
+    ticket = Ticket(lane, background)
+    with condition:
+        waiting[lane].append(ticket)
+        try:
+            while next_ticket() is not ticket:
+                if cancel is not None:
+                    cancel.check("queue")
+                # a bulk ticket can starve without any slot being
+                # released, check again once the oldest one would be
+                # promoted
+                condition.wait(timeout=max_wait if cancel is None
+                               else cancel_poll_s)
+        except Exception:
+            waiting[lane].remove(ticket)
+            # the next in line may be able to start now
+            condition.notify_all()
+            raise
+        waiting[lane].popleft()
+        running[lane] += 1
+
+        waited = time.time() - ticket.since
+        lane_stats = stats[lane]
+        lane_stats["admitted"] += 1
+        if waited > 0.001:
+            lane_stats["waited"] += 1
+        if lane == "bulk" and waited >= max_wait:
+            lane_stats["promoted"] += 1
+        lane_stats["max_wait_s"] = max(lane_stats["max_wait_s"], waited)
+        # another slot may still be free for the next waiter
+        condition.notify_all()
+
+
+def release(lane):
+    with condition:
+        running[lane] -= 1
+        condition.notify_all()
+
+
+@contextmanager
+def slot(diagram, output_format="png"):
+    """ Wait for a slot in the diagram's lane and hold it while the
+        block runs.  The lane is kept on the diagram as diagram.lane.
+    """
+    lane = classify(diagram, output_format)
+    diagram.lane = lane
+    acquire(lane, diagram.cancel, diagram.background)
+    try:
+        yield lane
+    finally:
+        release(lane)
@@ -0,0 +1,118 @@
+"""
+Decoded assets in shared memory, for pre-fork servers.
+
+publish() decodes every PNG under png/ once into a single
+multiprocessing.shared_memory block.  After that RackImage hands out
+read-only images mapped straight onto that block instead of decoding
+its own copy, so processes forked after publish() all share one copy of
+the pixels and a new worker costs next to no asset memory.
+
+    shared_assets.publish()
+    # fork workers here
+    ...
+    shared_assets.release()   # in the parent, on shutdown
+
+multiprocessing.shared_memory needs python 3.8, it's only imported by
+publish(), the lambda runtime never publishes.
+"""
+import logging
+import os
+from PIL import Image
+from . import utils
+
+logger = logging.getLogger()
+
+# RackImage key (full path) -> (mode, size, offset)
+manifest = {}
+block = None
+
+
+def shared_mode(mode):
+    if mode in ("RGB", "RGBA", "L"):
+        return mode
+    return "RGBA"
+
+
+def raw_bytes(img):
+    # pillow keeps RGB as 4 bytes a pixel, store it that way so the
+    # image can be mapped without a copy
+    if img.mode == "RGB":
+        return img.tobytes("raw", "RGBX")
+    return img.tobytes()
+
+
+def map_image(buf, mode, size, offset):
+    """ Read-only image over buf, pixels aren't copied.  Writing to it
+        (paste, draw) makes pillow copy it first.
+    """
+    img = utils.map_image(buf, mode, size, offset)
+    img.readonly = 1
+    return img
+
+
+def publish(png_dir=None):
+    """ Decode every asset into one shared memory block.  Returns the
+        number of bytes shared.
+    """
+    global block
+    from multiprocessing import shared_memory
+
+    if png_dir is None:
+        png_dir = os.path.join(utils.root_path, "png")
+
+    # size everything from the headers first, then decode one asset
+    # at a time straight into the block so no decoded copy lingers in
+    # this process to be inherited by the workers
+    entries = []
+    total = 0
+    for file_name in sorted(os.listdir(png_dir)):
+        if not file_name.endswith(".png"):
+            continue
+        key = os.path.join(png_dir, file_name)
+        with Image.open(key) as img:
+            mode = shared_mode(img.mode)
+            size = img.size
+        pixel_size = 1 if mode == "L" else 4
+        entries.append((key, mode, size, total))
+        total += size[0] * size[1] * pixel_size
+
+    release()
+    block = shared_memory.SharedMemory(create=True, size=max(total, 1))
+    for key, mode, size, offset in entries:
+        with Image.open(key) as img:
+            img.load()
+            if img.mode != mode:
+                img = img.convert(mode)
+            data = raw_bytes(img)
+        block.buf[offset:offset + len(data)] = data
+        manifest[key] = (mode, size, offset)
+
+    logger.info("Published {} assets, {} MB shared".format(
+        len(manifest), total // (1024 * 1024)))
+    return total
+
+
+def lookup(key):
+    """ Mapped image for a RackImage key, None if it wasn't published. """
+    entry = manifest.get(key)
+    if entry is None or block is None:
+        return None
+    mode, size, offset = entry
+    return map_image(block.buf, mode, size, offset)
+
+
+def release():
+    """ Free the block, only the process that published it should call
+        this, after the workers are gone.
+    """
+    global block
+
+    manifest.clear()
+    if block is not None:
+        try:
+            block.close()
+        except BufferError:
+            # images mapped in this process still hold views of it
+            pass
+        block.unlink()
+        block = None
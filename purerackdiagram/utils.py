@@ -1,6 +1,11 @@
 import json
 import asyncio
-import concurrent
+import functools
+import hashlib
+import concurrent.futures
+import threading
+import mmap
+import weakref
 # import time
 import logging
 from PIL import Image
@@ -8,16 +13,45 @@ from PIL import ImageDraw
 from PIL import ImageFont
 # from io import BytesIO
 import os
+import re
 import purerackdiagram
+from .cache import component_cache
+from . import cancellation
+from . import labels
+from . import memory
+from . import metrics
+from . import persist
+from . import prewarm
+from . import shared_assets
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 cache = {}
+cache_stats = {"hits": 0, "misses": 0}
 cache_lock = asyncio.Lock()
 root_path = os.path.dirname(purerackdiagram.__file__)
 ttf_path = os.path.join(root_path, "Lato-Regular.ttf")
 
+# CPU bound compositing (paste, rotate, text, alpha_composite) runs in
+# this pool.  Pillow releases the GIL in its C ops, so independent
+# components really do build in parallel.
+pool_size = int(os.environ.get("PURERACK_POOL_SIZE", os.cpu_count() or 1))
+cpu_pool = None
+cpu_pool_lock = threading.Lock()
+font_cache = threading.local()
+in_flight = 0
+in_flight_lock = threading.Lock()
+
+# assets are handed out shared and read-only, in debug mode every hand
+# out checks the pixels against a digest taken at load time so an
+# accidental write to a shared asset is caught right away.
+debug_assets = bool(os.environ.get("PURERACK_DEBUG_ASSETS"))
+
+# the catalog builder sets this to a set to collect every asset and
+# font file a render reads
+dependency_log = None
+
 global_config = None
 with open(os.path.join(root_path, 'config.json'), 'r') as f:
     global_config = json.load(f)
@@ -31,6 +65,11 @@ class RackImage():
     directly from local FS.  So the benefit of this caching is questionable
     but is already written.  Probably could replace this whole class
     with img = Image.open(key)  lol!
+
+    get_image_sync() hands out the one shared, decoded image, callers
+    must treat it as read-only (paste it, rotate it, etc).  Callers that
+    draw on the image (base images, labeled FM tiles) ask for
+    mutable=True and get their own copy.
     """
 
     def __init__(self, key):
@@ -39,7 +78,8 @@ class RackImage():
         # key is the file name, s3 terminology.
         self.key = os.path.join(root_path, key)
         self.img = None
-        self.io_lock = asyncio.Lock()
+        self.digest = None
+        self.io_lock = threading.Lock()
 
         # on object creation, see if this key has laready been requested.
         # potential race, if two object check but... worst case is we miss
@@ -51,63 +91,615 @@ class RackImage():
             cache[key] = self
             self.primary = True
 
-    async def get_image(self):
+    def get_image_sync(self, mutable=False):
+        record_dependency(self.key)
         if not self.primary:
-            return await self.primary_obj.get_image()
+            return self.primary_obj.get_image_sync(mutable)
 
-        # could be called by primary and secondary
-        # objects, so secondary must wait here
-        async with self.io_lock:
+        # could be called by primary and secondary objects from
+        # any worker thread, so secondary must wait here
+        with self.io_lock:
 
             # same image may be requested multiple times
             # when secondary comes through need to
             # return image that's already loaded
-            if self.img:
-                return self.img.copy()
-
-            loop = asyncio.get_event_loop()
+            if self.img is None:
+                cache_stats["misses"] += 1
+                self.load_img()
+            else:
+                cache_stats["hits"] += 1
 
-            # reading through asyncIO, it seems some OS
-            # implementations are not truly Async!!!
-            # now i'm going back to threads...
-            with concurrent.futures.ThreadPoolExecutor() as pool:
-                await loop.run_in_executor(pool, self.load_img)
+        if debug_assets:
+            self.check_img()
 
+        if mutable:
             return self.img.copy()
+        return self.img
 
-    def load_img(self):
-        # load image from disk
+    async def get_image(self, mutable=False):
+        return await run_cpu(self.get_image_sync, mutable)
 
-        self.img = Image.open(self.key)
-        self.img.load()
+    def load_img(self):
+        # load image from disk, or map it from shared memory when a
+        # pre-fork server has published the decoded assets
+        self.img = shared_assets.lookup(self.key)
+        if self.img is None:
+            with metrics.asset_load_seconds.time():
+                self.img = Image.open(self.key)
+                self.img.load()
+        if debug_assets:
+            self.digest = image_digest(self.img)
         logger.info("Loaded: {}".format(self.key))
 
+    def check_img(self):
+        if self.digest != image_digest(self.img):
+            raise Exception("Shared asset was modified: {}, use "
+                            "get_image_sync(mutable=True) to draw on an "
+                            "asset".format(self.key))
 
-def combine_images_vertically(images):
-    """ Combines a list of PIL images vertically
-        Args:
-            images: List of PIL image objects to be combined
+
+def check_assets():
+    """ Verify none of the shared cached assets have been written to,
+        only works when PURERACK_DEBUG_ASSETS is set.
+    """
+    for rack_img in list(cache.values()):
+        if rack_img.img is not None and rack_img.digest is not None:
+            rack_img.check_img()
+
+
+def record_dependency(path):
+    if dependency_log is not None:
+        dependency_log.add(path)
+
+
+def image_digest(img):
+    h = hashlib.sha256()
+    h.update(img.mode.encode())
+    h.update(str(img.size).encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def get_cpu_pool():
+    global cpu_pool
+
+    with cpu_pool_lock:
+        if cpu_pool is None:
+            cpu_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=pool_size, thread_name_prefix="purerack")
+        return cpu_pool
+
+
+def set_pool_size(size):
+    """ Resize the worker pool, the old pool finishes its queued work
+        in the background and new work goes to the new pool.
+    """
+    global cpu_pool
+    global pool_size
+
+    size = int(size)
+    if size < 1:
+        raise Exception("pool size must be at least 1")
+
+    with cpu_pool_lock:
+        pool_size = size
+        old_pool = cpu_pool
+        cpu_pool = None
+
+    if old_pool is not None:
+        old_pool.shutdown(wait=False)
+
+
+async def run_cpu(func, *args):
+    """ Run a CPU bound function in the worker pool without
+        blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_cpu_pool(), func, *args)
+
+
+# buffers of freed canvases, reused so a render doesn't page fault on
+# every 4KB of a fresh canvas
+canvas_buffers = []
+canvas_buffers_max = 4
+canvas_lock = threading.Lock()
+
+
+def get_canvas_buffer(num_bytes):
+    """ (buffer, reused), a reused buffer still has an old render in it. """
+    with canvas_lock:
+        for buf in canvas_buffers:
+            if num_bytes <= len(buf) <= 2 * num_bytes:
+                canvas_buffers.remove(buf)
+                return buf, True
+    return mmap.mmap(-1, num_bytes), False
+
+
+def put_canvas_buffer(buf):
+    with canvas_lock:
+        if len(canvas_buffers) < canvas_buffers_max:
+            canvas_buffers.append(buf)
+
+
+class Canvas():
+    """ The output image, allocated once.  view() hands out images that
+        share its pixels, so a component draws straight into its place
+        on the canvas with no image of its own and no copy afterwards.
+    """
+
+    def __init__(self, size, slots):
+        self.size = size
+        self.stride = size[0] * 4
+        # one spare row, a view's last row ends past the canvas' last
+        # pixel when it doesn't start at x = 0
+        self.buffer, reused = get_canvas_buffer(self.stride * (size[1] + 1))
+        self.image = map_image(self.buffer, "RGB", size, 0, self.stride)
+        # the buffer goes back to the pool once the image is freed
+        weakref.finalize(self.image, put_canvas_buffer, self.buffer)
+
+        if reused:
+            # every slot is drawn over, only the background beside
+            # narrower slots and between the components of a region
+            # still needs to be black
+            y_drawn = 0
+            for _, _, loc, slot_size, _, _ in sorted(slots,
+                                                     key=lambda s: s[2][1]):
+                y_end = loc[1] + slot_size[1]
+                if loc[1] > y_drawn:
+                    self.image.paste(0, (0, y_drawn, size[0], loc[1]))
+                y_drawn = max(y_drawn, y_end)
+                if loc[0] > 0:
+                    self.image.paste(0, (0, loc[1], loc[0], y_end))
+                if loc[0] + slot_size[0] < size[0]:
+                    self.image.paste(0, (loc[0] + slot_size[0], loc[1],
+                                         size[0], y_end))
+
+    def view(self, loc, size, mode):
+        """ size image at loc on the canvas, RGBA views keep their alpha
+            in the padding byte of the canvas' RGB pixels.
+        """
+        offset = loc[1] * self.stride + loc[0] * 4
+        view = map_image(self.buffer, mode, size, offset, self.stride)
+        # where its pixels are, for writers that work on the buffer
+        view.mapped = (self.buffer, offset, self.stride)
+        return view
+
+
+def map_image(buf, mode, size, offset, stride=0):
+    """ Image over buf, the pixels aren't copied.  stride is the bytes
+        per row, 0 for rows packed one after another.
     """
-    widths, heights = zip(*(i.size for i in images))
-    total_height = sum(heights)
-    total_width = max(widths)
+    core = Image.core.map_buffer(buf, size, "raw", offset, (mode, stride, 1))
+    return Image.new(mode, (1, 1))._new(core)
 
-    new_im = Image.new("RGB", (total_width, total_height))
 
+def base_image(key, target=None):
+    """ The asset a component starts from.  Draws into target, a canvas
+        view, when given, otherwise returns a private copy to draw on.
+    """
+    if target is None:
+        return RackImage(key).get_image_sync(mutable=True)
+    target.paste(RackImage(key).get_image_sync())
+    return target
+
+
+def stack_layout(parts):
+    """ Lay parts out top down, each centered horizontally.
+        Args:
+            parts: list of (size, slots, places), slots positioned within
+                   the part and the (name, ru height) of each slot
+        Returns (canvas size, slots positioned on the canvas, places),
+        places are (name, lowest RU, highest RU), RU 1 at the bottom
+    """
+    total_width = max(part[0][0] for part in parts)
+    total_height = sum(part[0][1] for part in parts)
+
+    slots = []
+    places = []
     y_offset = 0
-    for im in images:
-        # center the x difference if an image is slightly smaller width
-        x_offset = int((total_width - im.size[0]) / 2)
-        new_im.paste(im, (x_offset, y_offset))
-        y_offset += im.size[1]
-    return new_im
+    ru = sum(ru for part in parts for _, ru in part[2])
+    for size, part_slots, part_places in parts:
+        # center the x difference if a part is slightly smaller width
+        x_offset = int((total_width - size[0]) / 2)
+        for key, builder, loc, slot_size, mode, overlay in part_slots:
+            slots.append((key, builder,
+                          (loc[0] + x_offset, loc[1] + y_offset),
+                          slot_size, mode, overlay))
+        for name, slot_ru in part_places:
+            places.append((name, ru - slot_ru + 1, ru))
+            ru -= slot_ru
+        y_offset += size[1]
+    return (total_width, total_height), slots, places
 
 
-def apply_text(img, text, x_loc, y_loc, font_size=15):
+def parse_region(params):
+    """ The region of interest in params, None for the whole diagram.
+        component is a comma separated list of component names, see
+        Diagram.get_component_names(), ru_range is "low-high" or a single
+        RU, counted up from the bottom of the diagram like a rack.
+    """
+    region = {}
+    names = [name.strip().lower()
+             for name in str(params.get("component") or "").split(",")]
+    if any(names):
+        region["component"] = sorted(set(name for name in names if name))
+
+    ru_range = str(params.get("ru_range") or "").strip()
+    if ru_range:
+        match = re.match(r"^(\d+)(?:\s*-\s*(\d+))?$", ru_range)
+        if not match:
+            raise Exception("Invalid ru_range: {}, expecting \"5-8\" for "
+                            "RU 5 to 8, or \"5\"".format(ru_range))
+        low = int(match.group(1))
+        high = int(match.group(2) or low)
+        region["ru_range"] = [min(low, high), max(low, high)]
+    return region or None
+
+
+def name_matches(name, selected):
+    # "shelf2" is that shelf, "shelf" every shelf and "device1" every
+    # component of a rack's first device
+    return name == selected or name.startswith(selected + ".") or \
+        name.rstrip("0123456789") == selected
+
+
+def in_region(place, region):
+    name, low, high = place
+    names = region.get("component")
+    if names and not any(name_matches(name, n) for n in names):
+        return False
+    ru_range = region.get("ru_range")
+    if ru_range and (high < ru_range[0] or low > ru_range[1]):
+        return False
+    return True
+
+
+def select_region(slots, places, region):
+    """ The slots and places in region, moved so the region's top left
+        corner is (0, 0).  Returns (region size, slots, places).
+    """
+    selected = [(slot, place) for slot, place in zip(slots, places)
+                if in_region(place, region)]
+    if not selected:
+        raise Exception(
+            "Nothing in the region {}, the components are: {}".format(
+                json.dumps(region, sort_keys=True),
+                ", ".join("{} (RU {}-{})".format(*place)
+                          for place in places)))
+
+    left = min(slot[2][0] for slot, _ in selected)
+    top = min(slot[2][1] for slot, _ in selected)
+    right = max(slot[2][0] + slot[3][0] for slot, _ in selected)
+    bottom = max(slot[2][1] + slot[3][1] for slot, _ in selected)
+    region_slots = [
+        (key, builder, (loc[0] - left, loc[1] - top), size, mode, overlay)
+        for (key, builder, loc, size, mode, overlay), _ in selected]
+    return ((right - left, bottom - top), region_slots,
+            [place for _, place in selected])
+
+
+class Diagram():
+    """ Base for all the diagrams.  Subclasses provide get_components(),
+        the independent component builds as (key, builder) pairs, and
+        get_component_assets(), the base asset each one starts from.
+
+        The layout is known from the asset sizes before anything is
+        built, so the output canvas is allocated once and every builder
+        draws straight into its own region of it.  Components with the
+        same key have identical effective config and are built only
+        once, the others are copies of the first.  The same layout backs
+        both the sync and async render paths.
+
+        With a region of interest (component or ru_range) only the
+        components in it are built, at the same positions as in the
+        whole diagram, on a canvas the size of the region.
+    """
+    # model family, the label for the render metrics
+    family = "other"
+    # from parse_region(), None renders the whole diagram
+    region = None
+    # set by the profiler, render without caches on the calling thread
+    profiling = False
+    # cancellation.CancelToken of the request, checked between stages
+    cancel = None
+    # set by the pre-warmer, not live demand and not recorded as such
+    background = False
+
+    def get_key(self):
+        """ Canonical key for the diagram, any params that parse to the
+            same effective config get the same key.
+        """
+        config = self.config
+        if self.region is not None:
+            config = dict(config, region=self.region)
+        key = component_key(type(self).__name__, config)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_component_assets(self):
+        """ (key, asset key) of every component, in the same order as
+            get_components(), a component is the size of its asset.
+        """
+        raise NotImplementedError()
+
+    def get_component_labels(self):
+        """ (key, builder) of the labels.Overlay drawn over each
+            component, None for a component without labels, in the same
+            order as get_components().  The component's key is only its
+            hardware, so toggling labels reuses the built component.
+        """
+        return [None] * len(self.get_components())
+
+    def get_component_names(self):
+        """ Name of each component for the component param, in the same
+            order as get_components().
+        """
+        return ["component{}".format(i + 1)
+                for i in range(len(self.get_components()))]
+
+    def get_component_ru(self):
+        """ RU height of each component, in the same order as
+            get_components().
+        """
+        raise NotImplementedError()
+
+    def get_full_layout(self):
+        """ Canvas size, slots and places of the whole diagram, see
+            stack_layout().  Only asset headers are read.
+        """
+        parts = []
+        for (key, builder), (_, asset), overlay, name, ru in zip(
+                self.get_components(), self.get_component_assets(),
+                self.get_component_labels(), self.get_component_names(),
+                self.get_component_ru()):
+            size, mode = memory.asset_info(asset)
+            parts.append((size, [(key, builder, (0, 0), size, mode,
+                                  overlay)], [(name, ru)]))
+
+        if self.config["direction"] == "up":
+            parts.reverse()
+        return stack_layout(parts)
+
+    def get_region_layout(self):
+        # the whole diagram is laid out first, so a region keeps the
+        # positions and direction order it has in the whole diagram
+        size, slots, places = self.get_full_layout()
+        if self.region is not None:
+            return select_region(slots, places, self.region)
+        return size, slots, places
+
+    def get_layout(self):
+        """ Canvas size and every component's slot on it, as
+            (key, builder, (x, y), (width, height), mode, labels), top
+            down.  Only the components in the region when there is one.
+        """
+        size, slots, _ = self.get_region_layout()
+        return size, slots
+
+    def get_ru(self):
+        """ RU height of what's rendered, the region's when there is one. """
+        if self.region is None:
+            return self.config["ru"]
+        places = self.get_region_layout()[2]
+        return max(high for _, _, high in places) - \
+            min(low for _, low, _ in places) + 1
+
+    def get_unique_slots(self, slots):
+        # the same hardware with different labels is drawn again
+        unique = {}
+        for slot in slots:
+            if slot_id(slot) not in unique:
+                unique[slot_id(slot)] = slot
+                prewarm.record_component(slot[0], self)
+        return unique
+
+    def estimate_size(self):
+        """ Canvas size of the whole diagram worked out from the config
+            and the asset headers, without a slot per component, so a
+            huge config is cheap to reject.  Subclasses do the arithmetic.
+        """
+        return self.get_full_layout()[0]
+
+    def estimate_memory(self):
+        """ Bytes of image memory a render needs at its peak, just the
+            output canvas, components are drawn straight into it.
+        """
+        if self.region is not None:
+            return memory.image_bytes(self.get_layout()[0])
+        return memory.image_bytes(self.estimate_size())
+
+    def build_component(self, key, builder):
+        # built components are shared across diagrams and requests
+        img = component_cache.get(key)
+        if img is None:
+            img = builder()
+            component_cache.put(key, img)
+            persist.save_component(key, img)
+        return img
+
+    def draw_component(self, canvas, slot):
+        key, builder, loc, size, mode, overlay = slot
+        cancellation.check(self, "component")
+        target = canvas.view(loc, size, mode)
+
+        if overlay is not None:
+            # kept when its overlay is slow to draw, see below
+            labeled_key = component_key("labeled", [key, overlay[0]])
+            cached = None if self.profiling else \
+                component_cache.get(labeled_key)
+            if cached is not None:
+                target.paste(cached)
+                return
+
+        cached = None if self.profiling else component_cache.get(key)
+        if cached is not None:
+            target.paste(cached)
+        else:
+            img = builder(target)
+            if img is target:
+                # keep a copy for the next diagram that needs it
+                img = target.copy()
+                component_cache.put(key, img)
+                persist.save_component(key, img)
+            else:
+                # a shared asset (bezel, xfm, blank RU) is pasted as is
+                target.paste(img)
+
+        if overlay is not None:
+            layer = labels.get_overlay(*overlay, cached=not self.profiling)
+            layer.draw(target)
+            if layer.patches:
+                # patches composite over large areas, keeping the
+                # labeled copy is cheaper than drawing them again
+                component_cache.put(labeled_key, target.copy())
+
+    def copy_duplicates(self, canvas, slots, unique):
+        for slot in slots:
+            first = unique[slot_id(slot)]
+            if slot is not first:
+                canvas.view(slot[2], slot[3], slot[4]).paste(
+                    canvas.view(first[2], first[3], first[4]))
+
+    def start_memory(self):
+        # pillow's image memory isn't visible to tracemalloc, the peak
+        # is the resident set's growth from admission, see memory.py
+        self.memory = {"estimate": self.memory_estimate, "peak": None}
+        self.rss_start = memory.current_rss()
+
+    def record_memory(self):
+        """ Sample the render's memory, called when everything it holds
+            is alive: after composition and after the encode.
+        """
+        rss = memory.current_rss()
+        if rss is not None and self.rss_start is not None:
+            self.memory["peak"] = max(self.memory["peak"] or 0,
+                                      rss - self.rss_start, 0)
+        memory.record(self.memory["estimate"], self.memory["peak"])
+
+    def render(self):
+        """ Synchronous render, no event loop involved.  Components
+            still build in parallel in the worker pool.
+        """
+        size, slots = self.get_layout()
+        self.memory_estimate = memory.image_bytes(size)
+        memory.reserve(self.memory_estimate)
+        self.start_memory()
+        track_in_flight(1, self.background)
+        try:
+            with metrics.render_seconds.time(self.family):
+                unique = self.get_unique_slots(slots)
+                canvas = Canvas(size, slots)
+                if self.profiling:
+                    # the profiler only sees the thread it runs on
+                    for slot in unique.values():
+                        self.draw_component(canvas, slot)
+                    cancellation.check(self, "composition")
+                    self.copy_duplicates(canvas, slots, unique)
+                else:
+                    pool = get_cpu_pool()
+                    # every slot is its own region, builders never overlap
+                    futures = [pool.submit(self.draw_component, canvas,
+                                           slot)
+                               for slot in unique.values()]
+                    # every build is done with the canvas before it can
+                    # be freed, a cancelled one returns straight away
+                    concurrent.futures.wait(futures)
+                    for future in futures:
+                        future.result()
+                    cancellation.check(self, "composition")
+                    pool.submit(self.copy_duplicates, canvas, slots,
+                                unique).result()
+            self.record_memory()
+            return canvas.image
+        finally:
+            track_in_flight(-1, self.background)
+            memory.release(self.memory_estimate)
+
+    async def get_image(self):
+        """ Render on the caller's event loop, CPU work goes to the
+            worker pool so the loop is never blocked.
+        """
+        size, slots = self.get_layout()
+        self.memory_estimate = memory.image_bytes(size)
+        # waiting for memory blocks, keep it off the loop and the pool
+        reservation = asyncio.get_running_loop().run_in_executor(
+            None, memory.reserve, self.memory_estimate)
+        try:
+            await asyncio.shield(reservation)
+        except asyncio.CancelledError:
+            # the reserve still finishes in its thread, give the memory
+            # back once it has
+            reservation.add_done_callback(
+                functools.partial(release_reservation, self.memory_estimate))
+            raise
+        self.start_memory()
+        track_in_flight(1, self.background)
+        try:
+            with metrics.render_seconds.time(self.family):
+                unique = self.get_unique_slots(slots)
+                canvas = Canvas(size, slots)
+                tasks = [run_cpu(self.draw_component, canvas, slot)
+                         for slot in unique.values()]
+                # every build is done with the canvas before it can be
+                # freed, a cancelled one returns straight away
+                for result in await asyncio.gather(*tasks,
+                                                   return_exceptions=True):
+                    if isinstance(result, BaseException):
+                        raise result
+                cancellation.check(self, "composition")
+                await run_cpu(self.copy_duplicates, canvas, slots, unique)
+            self.record_memory()
+            return canvas.image
+        finally:
+            track_in_flight(-1, self.background)
+            memory.release(self.memory_estimate)
+
+
+def release_reservation(num_bytes, reservation):
+    # for a reserve() whose caller was cancelled while it waited
+    if not reservation.cancelled() and reservation.exception() is None:
+        memory.release(num_bytes)
+
+
+def slot_id(slot):
+    # slots with the same id draw identical pixels
+    return slot[0], slot[5] and slot[5][0]
+
+
+def track_in_flight(change, background=False):
+    """ Count of live renders in progress, background work waits for
+        zero.  Background renders (pre-warming) aren't counted.
+    """
+    global in_flight
+
+    if background:
+        return
+    with in_flight_lock:
+        in_flight += change
+
+
+def component_key(name, config):
+    """ Identical name and config always build the identical image. """
+    return "{}:{}".format(name, json.dumps(config, sort_keys=True))
+
+
+def get_font(font_size):
+    """ Parsing the ttf file is slow, keep one font per size per
+        thread, FreeType faces are not safe to share across threads.
+    """
     global ttf_path
 
+    record_dependency(ttf_path)
+    fonts = getattr(font_cache, "fonts", None)
+    if fonts is None:
+        fonts = font_cache.fonts = {}
+    if font_size not in fonts:
+        fonts[font_size] = ImageFont.truetype(ttf_path, size=font_size)
+    return fonts[font_size]
+
+
+def apply_text(img, text, x_loc, y_loc, font_size=15):
     draw = ImageDraw.Draw(img)
-    font = ImageFont.truetype(ttf_path, size=font_size)
+    font = get_font(font_size)
     w, _ = draw.textsize(text, font=font)
     x_loc = x_loc - w // 2
     draw.text((x_loc, y_loc), text, fill=(199, 89, 40), font=font)
@@ -116,3 +708,12 @@ def apply_text(img, text, x_loc, y_loc, font_size=15):
 def apply_text_centered(img, text, y_loc, font_size=15):
     x_loc = img.size[0] // 2
     apply_text(img, text, x_loc, y_loc, font_size)
+
+
+def is_true(value):
+    """ Query string params come in as strings, treat the usual
+        spellings of no/false as False.
+    """
+    if value in ['False', 'false', 'FALSE', 'no', '0', '', None]:
+        return False
+    return bool(value)
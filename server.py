@@ -0,0 +1,367 @@
+"""
+Pre-fork HTTP server.
+
+The parent decodes every asset once into shared memory, binds the
+listening socket and forks the render workers.  Each worker maps the
+shared assets read-only and serves requests with lambdaentry.respond(),
+so the responses are the same as the lambda's, without the base64.
+/metrics answers with the worker's metrics in the Prometheus text
+format.  Each worker takes requests on a thread each and the render
+scheduler decides which of them render, cheap previews ahead of bulk
+renders.  A request whose client disconnects, or that runs past
+PURERACK_DEADLINE_S, is cancelled at the render's next stage (see
+purerackdiagram.cancellation).  Workers that die are replaced.
+
+With --route each worker listens on its own local port instead and a
+router process routes every request to a worker on a consistent-hash
+ring of the diagram's canonical key (see purerackdiagram.routing), so a
+config is rendered and cached by one worker and the cache hit rate holds
+as workers are added.  The parent only forks and restarts the workers
+and the router, it runs no threads so nothing is forked mid-lock.
+--backends routes to other servers (host:port) instead of local workers.
+The router answers /metrics with its own routing counts,
+/metrics?worker=N with worker N's.
+
+    python server.py -w 4 -p 8080
+    python server.py -w 4 -p 8080 --route
+    curl "http://localhost:8080/?model=fa-x70r2&datapacks=45/45-63"
+"""
+import argparse
+import functools
+import http.client
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger()
+
+
+class DisconnectWatcher():
+    """ Calls a request's callback when its client closes the connection
+        while the request is being answered.  One thread watches every
+        connection in the process.
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def watch(self, sock, callback):
+        with self.lock:
+            self.selector.register(sock, selectors.EVENT_READ, callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name="purerack-disconnect")
+                self.thread.start()
+
+    def unwatch(self, sock):
+        with self.lock:
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select(timeout=1.0):
+                # the request is already read, a readable connection is
+                # closed unless the client pipelined another request
+                try:
+                    closed = key.fileobj.recv(1, socket.MSG_PEEK) == b""
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    closed = True
+                self.unwatch(key.fileobj)
+                if closed:
+                    key.data()
+
+
+watcher = DisconnectWatcher()
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        import lambdaentry
+        from purerackdiagram import cancellation
+
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/metrics":
+            self.send_metrics()
+            return
+
+        params = dict(urllib.parse.parse_qsl(url.query))
+        token = cancellation.CancelToken.for_request()
+        watcher.watch(self.connection, lambda: token.cancel("disconnect"))
+        try:
+            result = lambdaentry.respond(params, cancel=token)
+        finally:
+            watcher.unwatch(self.connection)
+        if token.reason == "disconnect":
+            return
+
+        # binary bodies are sent straight from the buffer they were
+        # assembled in
+        body = result["body"]
+        if isinstance(body, str):
+            body = body.encode()
+
+        self.send_response(result["statusCode"])
+        for name, value in result["headers"].items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug("Client went away before the response was sent")
+
+    def send_metrics(self):
+        from purerackdiagram import metrics
+
+        body = metrics.expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", metrics.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.address_string(), *args)
+
+
+class RouteHandler(BaseHTTPRequestHandler):
+    # set by route(), the ring of worker names and their addresses
+    ring = None
+    addresses = {}
+
+    def do_GET(self):
+        from purerackdiagram import routing
+
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == "/metrics":
+            if "worker" not in params:
+                RenderHandler.send_metrics(self)
+                return
+            worker = params["worker"]
+            if worker not in self.addresses:
+                self.send_error(404, "No worker {}".format(worker))
+                return
+            self.forward(worker, "/metrics")
+            return
+
+        worker = self.ring.acquire(routing.route_key(params))
+        try:
+            self.forward(worker, self.path, watch=True)
+        finally:
+            self.ring.release(worker)
+
+    def forward(self, worker, path, watch=False):
+        host, port = self.addresses[worker]
+        conn = http.client.HTTPConnection(host, port, timeout=300)
+        gone = []
+
+        def client_gone():
+            # closing the worker's connection cancels its render too
+            gone.append(True)
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+
+        try:
+            conn.request("GET", path)
+            if watch:
+                watcher.watch(self.connection, client_gone)
+            response = conn.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            if not gone:
+                logger.warning("Worker {} failed: {}".format(worker, e))
+                self.send_error(502, "Render worker unavailable")
+            return
+        finally:
+            if watch:
+                watcher.unwatch(self.connection)
+            conn.close()
+
+        self.send_response(response.status)
+        for name, value in response.getheaders():
+            if name.lower() not in ("connection", "transfer-encoding",
+                                    "date", "server"):
+                self.send_header(name, value)
+        self.send_header("X-Render-Worker", worker)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s " + format, self.address_string(), *args)
+
+
+def route(sock, addresses):
+    """ Serve the router on sock, addresses is
+        {worker name: (host, port)}.
+    """
+    from purerackdiagram import routing
+
+    RouteHandler.ring = routing.HashRing(sorted(addresses))
+    RouteHandler.addresses = addresses
+    server = ThreadingHTTPServer(sock.getsockname(), RouteHandler,
+                                 bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.serve_forever()
+
+
+def listen(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    return sock
+
+
+def serve(sock, threads, slots):
+    from purerackdiagram import scheduler
+    from purerackdiagram import utils
+
+    # the workers are the parallelism, keep each one's pool small
+    utils.set_pool_size(threads)
+    scheduler.set_limits(slots)
+    server = ThreadingHTTPServer(sock.getsockname(), RenderHandler,
+                                 bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    # the parent stops the workers with SIGTERM, queued persistence
+    # writes go out first
+    signal.signal(signal.SIGTERM, stop_worker)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server.serve_forever()
+
+
+def stop_worker(*_):
+    from purerackdiagram import persist
+
+    persist.stop(timeout=5)
+    os._exit(0)
+
+
+def start_worker(sock, threads, slots):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            serve(sock, threads, slots)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def start_router(sock, addresses):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            # the router holds no state worth flushing
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            route(sock, addresses)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def route_backends(args):
+    addresses = {}
+    for backend in args.backends.split(","):
+        host, port = backend.strip().rsplit(":", 1)
+        addresses[backend.strip()] = (host, int(port))
+
+    sock = listen(args.host, args.p)
+    logger.info("Routing {}:{} to {}".format(args.host, args.p,
+                                             ", ".join(sorted(addresses))))
+
+    def shutdown(*_):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    route(sock, addresses)
+
+
+def main(args):
+    from purerackdiagram import persist
+    from purerackdiagram import shared_assets
+
+    if args.backends:
+        route_backends(args)
+        return
+
+    shared_assets.publish()
+    # every fork below is from this thread alone, the parent never
+    # writes and each worker starts its own persistence writer
+    persist.stop_thread()
+
+    sock = listen(args.host, args.p)
+    logger.info("Listening on {}:{} with {} workers".format(
+        args.host, args.p, args.w))
+
+    # a routed worker keeps its own socket, and so its place on the
+    # ring, across restarts
+    if args.route:
+        socks = [listen("127.0.0.1", 0) for _ in range(args.w)]
+    else:
+        socks = [sock] * args.w
+
+    # each child's start, kept to restart it the same way
+    starts = [functools.partial(start_worker, worker_sock, args.threads,
+                                args.slots) for worker_sock in socks]
+    if args.route:
+        starts.append(functools.partial(
+            start_router, sock, {str(i): worker_sock.getsockname()
+                                 for i, worker_sock in enumerate(socks)}))
+    workers = {start(): start for start in starts}
+
+    def shutdown(*_):
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            os.waitpid(pid, 0)
+        shared_assets.release()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        pid, status = os.wait()
+        if pid in workers:
+            start = workers.pop(pid)
+            logger.warning("Process {} exited with {}, restarting".format(
+                pid, status))
+            workers[start()] = start
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes")
+    parser.add_argument('-p', type=int, default=8080, help="port")
+    parser.add_argument('--host', default="0.0.0.0")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="render threads per worker")
+    parser.add_argument('--slots', type=int, default=2,
+                        help="renders at once per worker, half for bulk")
+    parser.add_argument('--route', action="store_true",
+                        help="route requests to workers by diagram key")
+    parser.add_argument('--backends',
+                        help="route to these host:port servers instead "
+                        "of local workers")
+    main(parser.parse_args())
@@ -6,8 +6,8 @@ import hashlib
 import io
 import queue
 import os
+import time
 import lambdaentry
-from purerackdiagram.utils import global_config
 import purerackdiagram
 # import asyncio
 import json
@@ -166,6 +166,15 @@ def test_lambda():
     pprint(results)
 
 
+def test_name(params):
+    name = ""
+    for n in params.values():
+        if isinstance(n, str):
+            n = n.replace("/", '-')
+        name += str(n)+"_"
+    return name + '.png'
+
+
 class TestWorker(threading.Thread):
     def __init__(self, q, results):
         threading.Thread.__init__(self)
@@ -184,31 +193,27 @@ class TestWorker(threading.Thread):
             if 'addoncards' in item:
                 if item['addoncards'] == "2ethbaset":
                     a = 2
-            img = purerackdiagram.get_image_sync(item)
-
-            name = ""
-            for n in item.values():
-                if isinstance(n, str):
-                    n = n.replace("/", '-')
-                name += str(n)+"_"
-            name += '.png'
-
-            h = hashlib.sha256()
-            with io.BytesIO() as memf:
-                img.save(memf, 'PNG')
-                data = memf.getvalue()
-                h.update(data)
-                img.save(os.path.join(save_dir, name))
-
-                self.results[name] = h.hexdigest()
-            self.q.task_done()
+            name = test_name(item)
+            # a failed render is a changed image, and never leaves
+            # q.join() waiting
+            try:
+                img = purerackdiagram.get_image_sync(item)
+
+                h = hashlib.sha256()
+                with io.BytesIO() as memf:
+                    img.save(memf, 'PNG')
+                    data = memf.getvalue()
+                    h.update(data)
+                    img.save(os.path.join(save_dir, name))
+
+                    self.results[name] = h.hexdigest()
+            except Exception as e:
+                self.results[name] = repr(e)
+            finally:
+                self.q.task_done()
 
 
 def test_all(args):
-    models = global_config['pci_config_lookup']
-    dps = ['45/45-31/63-45', '3/127-24']
-    csizes = ['366', '879', '1390']
-
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
@@ -219,54 +224,12 @@ def test_all(args):
         t.setDaemon(True)
         t.start()
 
-    count = 0
-    # front:
-    for model in models:
-        model = model[:8]
-        for dp_label in [True, False]:
-            if 'c' in model:
-                for csize in csizes:
-                    count += 1
-                    params = {"model": model,
-                              "fm_label": True,
-                              "dp_label": dp_label,
-                              "csize": csize}
-                    q.put(params)
-            else:
-                for dp in dps:
-                    # if count > 3:
-                    #    break
-                    count += 1
-                    params = {"model": model,
-                              "fm_label": True,
-                              "dp_label": dp_label,
-                              "datapacks": dp}
-
-                    q.put(params)
-
-    # back:
-    addon_cards = global_config['pci_valid_cards']
-
-    for model in models:
-        model = model[:8]
-        for card in addon_cards:
-            if 'c' in model:
-                for csize in csizes:
-                    params = {"model": model,
-                              "addoncards": card,
-                              "face": "back",
-                              "csize": csize}
-                    q.put(params)
-            else:
-                for dp in dps:
-                    params = {"model": model,
-                              "datapacks": dp,
-                              "addoncards": card,
-                              "face": "back"}
-                    q.put(params)
-    
+    # every model x datapacks x addon card x face x csize we ship
+    for params in purerackdiagram.bundle.product_matrix():
+        q.put(params)
+
     for test in more_tests:
-        q.put(test)
+        q.put(test["queryStringParameters"])
 
     q.join()
 
@@ -287,9 +250,377 @@ def test_all(args):
     print("Test Complete {} Errors Found".format(errors))
 
 
+def digest_worker(params):
+    name = test_name(params)
+    try:
+        return name, purerackdiagram.render_digest(dict(params))
+    except Exception as e:
+        # invalid configs are checked too, by their error
+        return name, "error: {}".format(e)
+
+
+def test_digest(args):
+    # raw pixel digests, no png encode, in a process pool
+    import multiprocessing
+
+    all_params = purerackdiagram.bundle.product_matrix()
+    all_params += [test["queryStringParameters"] for test in more_tests]
+
+    processes = args.t if args.t > 1 else os.cpu_count()
+    start = time.time()
+    with multiprocessing.Pool(processes=processes) as pool:
+        results = dict(pool.map(digest_worker, all_params, chunksize=4))
+    print("Rendered {} diagrams in {:.1f}s".format(
+        len(results), time.time() - start))
+
+    if args.update:
+        with open("test_validation_digest.json", "w") as f:
+            json.dump(results, f, indent=0, sort_keys=True)
+        print("Wrote test_validation_digest.json")
+        return
+
+    with open("test_validation_digest.json") as f:
+        validation = json.load(f)
+
+    errors = 0
+    for key in results:
+        if key not in validation:
+            errors += 1
+            print("WARNING missing key:{}".format(key))
+        elif results[key] != validation[key]:
+            errors += 1
+            print("Error Image Changed!!:{}".format(key))
+    print("Test Complete {} Errors Found".format(errors))
+
+
+bench_tests = [
+    {"model": "fa-x70r2",
+     "datapacks": "45/45-63/63-63/63-63/63-512",
+     "fm_label": True,
+     "dp_label": True},
+    {"model": "fb",
+     "chassis": 10,
+     "face": "front",
+     "blades": "17:0-69,52:70-149"},
+    {"model": "fb",
+     "chassis": 10,
+     "face": "back"},
+]
+
+
+def test_bench(args):
+    # compare a single worker against the full pool for
+    # multi-shelf and multi-chassis diagrams
+    from purerackdiagram import utils
+
+    pool_sizes = [1, args.t if args.t > 1 else os.cpu_count()]
+    for params in bench_tests:
+        # warm the asset cache so only compositing is measured
+        purerackdiagram.get_image_sync(params.copy())
+
+        times = []
+        for size in pool_sizes:
+            utils.set_pool_size(size)
+            start = time.time()
+            for _ in range(args.n):
+                purerackdiagram.get_image_sync(params.copy())
+            times.append((time.time() - start) / args.n)
+
+        print("{}: {}".format(params, ", ".join(
+            "pool {}: {:.3f}s".format(size, t)
+            for size, t in zip(pool_sizes, times))))
+        print("    speedup: {:.2f}x".format(times[0] / times[-1]))
+
+
+def check_cancelled_render_releases_memory():
+    # cancelled while waiting for memory, the reservation made after the
+    # cancel is given back
+    import asyncio
+    from purerackdiagram import memory
+
+    async def cancel_waiting_render():
+        # the process is full, the render waits for memory
+        with memory.condition:
+            memory.reserved += memory.process_budget
+        task = asyncio.ensure_future(
+            purerackdiagram.render_async({"model": "fb", "chassis": 2}))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        memory.release(memory.process_budget)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # the release lands on the loop, keep it running until it has
+        for _ in range(100):
+            if memory.reserved == 0:
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(cancel_waiting_render())
+    assert memory.reserved == 0, memory.reserved
+
+    # cancelled by its token between components
+    diagram = purerackdiagram.get_diagram({"model": "fb", "chassis": 2})
+    diagram.cancel = purerackdiagram.cancellation.CancelToken()
+    diagram.cancel.cancel("disconnect")
+    try:
+        diagram.render()
+        raise AssertionError("render wasn't cancelled")
+    except purerackdiagram.cancellation.Cancelled:
+        pass
+    assert memory.reserved == 0, memory.reserved
+
+
+def check_dry_run_rejects_over_budget():
+    # the same answer the render would give, without laying it out
+    result = lambdaentry.respond({"model": "fb", "chassis": 200000,
+                                  "dry_run": True})
+    body = json.loads(result["body"])
+    assert result["statusCode"] == 400 and not body["valid"], body
+    assert "limit" in body["error"], body
+
+    result = lambdaentry.respond({"model": "fb", "chassis": 2,
+                                  "dry_run": True})
+    config = json.loads(result["body"])["config"]
+    assert config["memory_estimate"] <= config["memory_budget"], config
+
+
+def check_dry_run_rejects_overlapping_datapacks():
+    # the render would fail laying out the fms
+    result = lambdaentry.respond({"model": "fa-x70r2",
+                                  "datapacks": "127/127", "dry_run": True})
+    body = json.loads(result["body"])
+    assert result["statusCode"] == 400 and not body["valid"], body
+    assert "Overlapping" in body["error"], body
+
+
+def check_metric_shards_fold():
+    # a thread per request, never scraped, keeps a bounded shard list
+    from purerackdiagram import metrics
+
+    counter = metrics.Counter("purerack_test_total", "test", ["lane"])
+    for _ in range(500):
+        thread = threading.Thread(target=counter.inc, args=("a",))
+        thread.start()
+        thread.join()
+    assert len(counter.shards) <= metrics.fold_shards, len(counter.shards)
+    assert counter.collect() == {("a",): 500}, counter.collect()
+    metrics.registry.remove(counter)
+
+
+def check_frequency_sketch():
+    from purerackdiagram import prewarm
+
+    sketch = prewarm.FrequencySketch(capacity=3, decay_every=1000)
+    for key, count in [("a", 5), ("b", 3), ("c", 1)]:
+        for _ in range(count):
+            sketch.record(key, key)
+    # full, the new key replaces the coldest and inherits its count
+    sketch.record("d", "d")
+    assert [key for key, _, _ in sketch.hottest(3)] == ["a", "b", "d"]
+    assert sketch.counts["d"] == 2, sketch.counts
+    sketch.decay()
+    assert sketch.counts == {"a": 2, "b": 1, "d": 1}, sketch.counts
+
+
+def check_memory_admission():
+    from purerackdiagram import memory
+
+    try:
+        memory.reserve(memory.request_budget + 1)
+        raise AssertionError("over the request budget was admitted")
+    except AssertionError:
+        raise
+    except Exception:
+        pass
+
+    # a full process waits, then gives up
+    budgets = memory.process_budget, memory.wait_timeout
+    memory.process_budget, memory.wait_timeout = memory.request_budget, 0.1
+    try:
+        memory.reserve(memory.request_budget)
+        try:
+            memory.reserve(1)
+            raise AssertionError("over the process budget was admitted")
+        except AssertionError:
+            raise
+        except Exception:
+            pass
+        memory.release(memory.request_budget)
+        memory.reserve(1)
+        memory.release(1)
+    finally:
+        memory.process_budget, memory.wait_timeout = budgets
+    assert memory.reserved == 0, memory.reserved
+
+
+def check_scheduler_lanes():
+    from purerackdiagram import scheduler
+
+    small = purerackdiagram.get_diagram({"model": "fa-x70r2",
+                                         "datapacks": "45/45"})
+    big = purerackdiagram.get_diagram({"model": "fb", "chassis": 10})
+    assert scheduler.classify(small) == "interactive"
+    assert scheduler.classify(big) == "bulk"
+
+    limits = dict(scheduler.limits)
+    scheduler.set_limits(2, 1)
+    try:
+        scheduler.acquire("bulk")
+        # bulk only ever gets its share, a preview still starts
+        waiter = threading.Thread(target=scheduler.acquire, args=("bulk",))
+        waiter.start()
+        time.sleep(0.2)
+        assert scheduler.running["bulk"] == 1, scheduler.running
+        scheduler.acquire("interactive")
+        scheduler.release("interactive")
+        scheduler.release("bulk")
+        waiter.join(5)
+        assert not waiter.is_alive() and scheduler.running["bulk"] == 1
+        scheduler.release("bulk")
+    finally:
+        scheduler.set_limits(limits["total"], limits["bulk"])
+
+
+def check_persist_queue():
+    from purerackdiagram import persist
+
+    class BlockedStore():
+        # holds the writer on its first put
+        def __init__(self):
+            self.release = threading.Event()
+            self.objects = {}
+
+        def put(self, key, data):
+            self.release.wait(10)
+            self.objects[key] = data
+
+    store = BlockedStore()
+    max_writes = persist.max_writes
+    persist.max_writes = 2
+    coalesced = persist.stats["coalesced"]
+    dropped = persist.stats["dropped"]
+    try:
+        writer = persist.WriteBehind(store)
+        writer.submit("first", b"1", 1)
+        while writer.depth():
+            time.sleep(0.01)
+        # the writer is busy, these queue up behind it
+        assert writer.submit("a", b"old", 3)
+        assert writer.submit("a", b"new", 3)
+        assert writer.submit("b", b"b", 1)
+        assert not writer.submit("c", b"c", 1)
+        assert persist.stats["coalesced"] == coalesced + 1
+        assert persist.stats["dropped"] == dropped + 1
+        store.release.set()
+        assert writer.stop(10)
+    finally:
+        persist.max_writes = max_writes
+    assert store.objects == {"first": b"1", "a": b"new", "b": b"b"}, \
+        store.objects
+
+
+def check_hash_ring():
+    from purerackdiagram import routing
+
+    keys = ["config{}".format(i) for i in range(4000)]
+    ring = routing.HashRing(["w0", "w1", "w2", "w3"])
+    owners = {key: ring.lookup(key) for key in keys}
+    for node in ["w0", "w1", "w2", "w3"]:
+        share = list(owners.values()).count(node) / float(len(keys))
+        assert 0.18 < share < 0.32, (node, share)
+
+    # a new worker only takes keys, about 1/n of them
+    ring.add("w4")
+    moved = [key for key in keys if ring.lookup(key) != owners[key]]
+    assert all(ring.lookup(key) == "w4" for key in moved)
+    assert 0.12 < len(moved) / float(len(keys)) < 0.28, len(moved)
+    ring.remove("w4")
+    assert all(ring.lookup(key) == owners[key] for key in keys)
+
+    # a hot key spills past its owner once the owner is over the bound
+    acquired = [ring.acquire("hot") for _ in range(8)]
+    assert acquired[0] == ring.lookup("hot")
+    assert len(set(acquired)) > 1, acquired
+    for node in acquired:
+        ring.release(node)
+    assert sum(ring.load.values()) == 0, ring.load
+
+
+def check_cancel_token():
+    from purerackdiagram import cancellation
+
+    token = cancellation.CancelToken(deadline=time.time() - 1)
+    assert token.cancelled and token.reason == "deadline", token.reason
+    token = cancellation.CancelToken.for_request()
+    token.cancel("disconnect")
+    token.cancel("deadline")
+    assert token.reason == "disconnect", token.reason
+
+    diagram = purerackdiagram.get_diagram({"model": "fb", "chassis": 3})
+    diagram.cancel = token
+    try:
+        purerackdiagram.render_png(diagram)
+        raise AssertionError("render wasn't cancelled")
+    except cancellation.Cancelled as e:
+        assert e.stage in ("queue", "component"), e.stage
+
+
+def check_region_render():
+    # a region is the same pixels as its part of the whole diagram
+    from PIL import ImageChops
+
+    params = {"model": "fa-x70r2", "datapacks": "45/45-63/63-63/63",
+              "direction": "down"}
+    full = purerackdiagram.render_sync(dict(params)).copy()
+    whole = purerackdiagram.get_diagram(dict(params))
+    _, slots, places = whole.get_full_layout()
+    for region in [{"component": "shelf1"}, {"ru_range": "4-9"}]:
+        diagram = purerackdiagram.get_diagram(dict(params, **region))
+        size, region_slots, region_places = diagram.get_region_layout()
+        loc = slots[places.index(region_places[0])][2]
+        top = loc[1] - region_slots[0][2][1]
+        left = loc[0] - region_slots[0][2][0]
+        img = purerackdiagram.render_sync(dict(params, **region))
+        part = full.crop((left, top, left + size[0], top + size[1]))
+        assert ImageChops.difference(img, part).getbbox() is None, region
+
+
+unit_checks = [check_cancelled_render_releases_memory,
+               check_dry_run_rejects_over_budget,
+               check_dry_run_rejects_overlapping_datapacks,
+               check_metric_shards_fold,
+               check_frequency_sketch,
+               check_memory_admission,
+               check_scheduler_lanes,
+               check_persist_queue,
+               check_hash_ring,
+               check_cancel_token,
+               check_region_render]
+
+
+def test_units(args):
+    errors = 0
+    for check in unit_checks:
+        try:
+            check()
+            print("ok   {}".format(check.__name__))
+        except Exception as e:
+            errors += 1
+            print("FAIL {}: {!r}".format(check.__name__, e))
+    print("Test Complete {} Errors Found".format(errors))
+
+
 def main(args):
     if args.testtype == 'all':
         test_all(args)
+    elif args.testtype == 'bench':
+        test_bench(args)
+    elif args.testtype == 'digest':
+        test_digest(args)
+    elif args.testtype == 'units':
+        test_units(args)
     else:
         test_lambda()
 
@@ -297,8 +628,15 @@ def main(args):
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('testtype', choices=['all', 'lambda'], default='all',
+    parser.add_argument('testtype', choices=['all', 'lambda', 'bench', 'digest',
+                                             'units'],
+                        default='all',
                         nargs='?',
                         help="Test all options, or test through lamdba entry")
     parser.add_argument('-t', type=int, help="number of threads", default=1)
+    parser.add_argument('-n', type=int, default=5,
+                        help="bench iterations per diagram")
+    parser.add_argument('--update', action='store_true',
+                        help="digest: write test_validation_digest.json "
+                             "instead of checking against it")
     main(parser.parse_args())